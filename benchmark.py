@@ -0,0 +1,394 @@
+# 商品一覧・商品・感想ページのパースのベンチマーク
+#
+# fixtures/ に保存した HTML を使うので，ネットワークにはアクセスしない
+# パースの変更が効いているかを比べられるように，結果は JSON で出力する
+#
+#   python benchmark.py                       # 全ケースを実行して JSON を表示
+#   python benchmark.py -n 50 -o bench.json   # 50回ずつ実行してファイルに保存
+#   python benchmark.py --profile listing/products
+#   python benchmark.py --record listing URL  # 実際のページを fixtures に追加
+#   python benchmark.py --parsers             # bs4.diagnose のパーサ比較
+#   python benchmark.py --only e2e --latency 50  # 通しの計測に待ち時間を入れる
+#   python benchmark.py --only e2e --cassette cassettes/site
+#                                  # fixtures の代わりに記録したカセットを使う
+
+import argparse
+import cProfile
+import glob
+import json
+import os
+import platform
+import pstats
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Callable, List, Optional
+
+import bs4
+from bs4 import SoupStrainer
+from bs4 import diagnose
+
+import cassette
+import http_session
+import parsing
+import products_lambda
+import urls_lambda
+import reviews_lambda
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'fixtures')
+
+# 保存したページの文字コード
+ENCODING = 'utf-8'
+
+# 通しの計測で使うドメイン (FixtureAdapter が fixtures/ から返す)
+FIXTURE_DOMAIN = 'http://fixtures'
+
+PHASES = ('decode', 'build', 'select', 'extract')
+
+
+class Case:
+    """
+    1種類のページのパースを4つのフェーズに分けて計測する
+
+        decode  : bytes -> str
+        build   : 木の構築 (parse_only, limit を指定できる)
+        select  : カードの要素を CSS セレクタで選ぶ
+        extract : カードから値を取り出す
+    """
+
+    def __init__(self, name: str, kind: str,
+                 select: Callable, extract: Callable,
+                 parse_only: Optional[SoupStrainer] = None,
+                 limit: Optional[int] = None):
+        self.name = name
+        self.kind = kind
+        self.select = select
+        self.extract = extract
+        self.parse_only = parse_only
+        self.limit = limit
+
+    def run(self, data: bytes) -> dict:
+        timings = {}
+
+        start = time.perf_counter()
+        text = data.decode(ENCODING)
+        timings['decode'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        soup = parsing.parse(text, self.parse_only, self.limit)
+        timings['build'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        cards = self.select(soup)
+        timings['select'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        self.extract(cards)
+        timings['extract'] = time.perf_counter() - start
+
+        return timings
+
+
+def products_cards(soup):
+    return soup.select('div[class="card-product"]')[
+        :products_lambda.CARDS_PER_PAGE]
+
+
+def products_rows(cards):
+    return [products_lambda.parse_card(card, 'no title', '') for card in cards]
+
+
+def urls_rows(cards):
+    return [urls_lambda.parse_card(card) for card in cards]
+
+
+def review_rows(cards):
+    return [reviews_lambda.parse_review(card, 0) for card in cards]
+
+
+# strainer/limit なしのケースは，全体の木を作っていた以前のやり方との比較用
+CASES = [
+    Case('listing/products', 'listing', products_cards, products_rows,
+         products_lambda.CARD_STRAINER, products_lambda.CARDS_PER_PAGE),
+    Case('listing/products:full', 'listing', products_cards, products_rows),
+    Case('listing/urls', 'listing',
+         lambda soup: soup.select('.card-product'), urls_rows,
+         urls_lambda.CARD_STRAINER),
+    Case('listing/urls:full', 'listing',
+         lambda soup: soup.select('.card-product'), urls_rows),
+    Case('product/title', 'product', lambda soup: soup,
+         products_lambda.parse_title, products_lambda.TITLE_STRAINER, 1),
+    Case('product/title:full', 'product', lambda soup: soup,
+         products_lambda.parse_title),
+    Case('reviews/page', 'reviews',
+         lambda soup: soup.select('.review-list__content'), review_rows,
+         reviews_lambda.REVIEW_STRAINER, reviews_lambda.REVIEWS_PER_PAGE),
+    Case('reviews/page:full', 'reviews',
+         lambda soup: soup.select('.review-list__content'), review_rows),
+]
+
+
+def page_kind(url: str) -> str:
+    # URL のパスから，商品一覧・商品・感想ページのどれかを決める
+    if '/product/reviews/' in url:
+        return 'reviews'
+    if '/product/detail/' in url:
+        return 'product'
+    return 'listing'
+
+
+class FixtureAdapter(cassette.ReplayAdapter):
+    """
+    FIXTURE_DOMAIN へのリクエストに fixtures/ の HTML を返す
+    (カセットの代わりに，ページの種類ごとに1つの HTML を返す再生)
+    """
+
+    def __init__(self, corpus: dict, latency: float = 0.0):
+        super().__init__(latency=latency)
+        self.corpus = corpus
+
+    def lookup(self, request):
+        data = self.corpus[page_kind(request.url)][0]
+        headers = {'Content-Type': 'text/html; charset=UTF-8'}
+        return 200, headers, data, 0.0
+
+
+class CassetteAdapter(cassette.ReplayAdapter):
+    """
+    FIXTURE_DOMAIN へのリクエストに，カセットに記録したページを返す
+    記録した URL のドメインを FIXTURE_DOMAIN に置き換えて探し，
+    なければ同じ種類の記録したページを順番に返す
+    """
+
+    def __init__(self, tape: cassette.Cassette, latency: float = 0.0):
+        super().__init__(tape, latency=latency)
+        self.pages = {}
+        for key, entry in tape.index.items():
+            method, url = key.split(' ', 1)
+            if method == 'GET' and entry['status'] == 200:
+                path = url.split('/', 3)[3] if url.count('/') >= 3 else ''
+                self.pages[FIXTURE_DOMAIN + '/' + path] = url
+        self.kinds = {}
+        for url in self.pages.values():
+            self.kinds.setdefault(page_kind(url), []).append(url)
+        self.served = 0
+
+    def lookup(self, request):
+        url = self.pages.get(request.url)
+        if url is None:
+            urls = self.kinds.get(page_kind(request.url))
+            if not urls:
+                return None
+            url = urls[self.served % len(urls)]
+            self.served += 1
+
+        entry = self.cassette.play('GET', url)
+        return (entry['status'], entry['headers'],
+                self.cassette.get_blob(entry['body']), entry['elapsed'])
+
+
+def end_to_end_cases() -> List[tuple]:
+    # ハンドラの関数をそのまま呼ぶ (HTTP は FixtureAdapter が返す)
+    listing_url = FIXTURE_DOMAIN + '/search?sort=11&page=1'
+    reviews_url = FIXTURE_DOMAIN + '/product/reviews/01234/100000'
+
+    def products():
+        # 商品名のキャッシュを空にして，毎回商品ページも取得する
+        products_lambda.TITLE_CACHE = products_lambda.TitleCache(':memory:')
+        products_lambda.find_reviews_urls(listing_url)
+
+    return [
+        ('e2e/products.find_reviews_urls', products),
+        ('e2e/urls.find_reviews_urls',
+         lambda: urls_lambda.find_reviews_urls(listing_url)),
+        ('e2e/reviews.get_reviews_per_page',
+         lambda: reviews_lambda.get_reviews_per_page(0, reviews_url, 1)),
+    ]
+
+
+def load_corpus() -> dict:
+    # fixtures/<種類>*.html を種類ごとに読み込む
+    corpus = {}
+    for kind in ('listing', 'product', 'reviews'):
+        pages = []
+        for path in sorted(glob.glob(os.path.join(FIXTURES, kind + '*.html'))):
+            with open(path, 'rb') as f:
+                pages.append(f.read())
+        corpus[kind] = pages
+    return corpus
+
+
+def summarize(samples: List[float]) -> dict:
+    return {
+        'mean_ms': statistics.mean(samples) * 1000,
+        'median_ms': statistics.median(samples) * 1000,
+        'min_ms': min(samples) * 1000,
+    }
+
+
+def peak_memory(fn: Callable) -> int:
+    # fn 実行中の Python のメモリ使用量のピーク (KB)
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak // 1024
+
+
+def bench_case(case: Case, pages: List[bytes], iterations: int) -> dict:
+    samples = {phase: [] for phase in PHASES}
+    samples['total'] = []
+
+    # 1回目はウォームアップ
+    for data in pages:
+        case.run(data)
+
+    for _ in range(iterations):
+        for data in pages:
+            timings = case.run(data)
+            for phase in PHASES:
+                samples[phase].append(timings[phase])
+            samples['total'].append(sum(timings.values()))
+
+    return {
+        'pages': len(pages),
+        'phases': {phase: summarize(values)
+                   for phase, values in samples.items()},
+        'peak_kb': max(peak_memory(lambda: case.run(data)) for data in pages),
+    }
+
+
+def bench_end_to_end(fn: Callable, iterations: int) -> dict:
+    fn()
+
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+
+    return {
+        'phases': {'total': summarize(samples)},
+        'peak_kb': peak_memory(fn),
+    }
+
+
+def mount_fixtures(corpus: dict, latency: float = 0.0,
+                   tape: Optional[str] = None):
+    # tape (カセットのディレクトリ) を指定すると，fixtures の代わりに使う
+    if tape:
+        adapter = CassetteAdapter(cassette.Cassette(tape), latency)
+    else:
+        adapter = FixtureAdapter(corpus, latency)
+    http_session.SESSION.mount(FIXTURE_DOMAIN + '/', adapter)
+    products_lambda.DOMAIN = FIXTURE_DOMAIN
+    urls_lambda.DOMAIN = FIXTURE_DOMAIN
+
+
+def run(iterations: int, only: Optional[str] = None,
+        latency: float = 0.0, tape: Optional[str] = None) -> dict:
+    corpus = load_corpus()
+    mount_fixtures(corpus, latency, tape)
+
+    results = {}
+    for case in CASES:
+        if only and not case.name.startswith(only):
+            continue
+        if corpus[case.kind]:
+            results[case.name] = bench_case(case, corpus[case.kind],
+                                            iterations)
+
+    for name, fn in end_to_end_cases():
+        if only and not name.startswith(only):
+            continue
+        results[name] = bench_end_to_end(fn, iterations)
+
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'bs4': bs4.__version__,
+            'machine': platform.machine(),
+        },
+        'iterations': iterations,
+        'latency_ms': latency * 1000,
+        'cassette': tape,
+        'corpus': {kind: len(pages) for kind, pages in corpus.items()},
+        'results': results,
+    }
+
+
+def profile(name: str, iterations: int, tape: Optional[str] = None):
+    # bs4.diagnose.profile と同じく cProfile で，どこに時間がかかるかを見る
+    corpus = load_corpus()
+    mount_fixtures(corpus, tape=tape)
+
+    cases = {case.name: case for case in CASES}
+    if name in cases:
+        case = cases[name]
+        pages = corpus[case.kind]
+
+        def fn():
+            for data in pages:
+                case.run(data)
+    else:
+        fn = dict(end_to_end_cases())[name]
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    for _ in range(iterations):
+        fn()
+    profiler.disable()
+
+    stats = pstats.Stats(profiler)
+    stats.sort_stats('cumulative')
+    stats.print_stats(40)
+
+
+def record(kind: str, url: str):
+    # 実際のページを fixtures/<種類>-<番号>.html として保存する
+    data = http_session.get(url).content
+    existing = glob.glob(os.path.join(FIXTURES, kind + '*.html'))
+    path = os.path.join(FIXTURES, '%s-%d.html' % (kind, len(existing)))
+    with open(path, 'wb') as f:
+        f.write(data)
+    print('saved', path, len(data), 'bytes')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--iterations', type=int, default=20,
+                        help='1ケースあたりの実行回数')
+    parser.add_argument('-o', '--output', help='結果の JSON の保存先')
+    parser.add_argument('--only', help='この名前で始まるケースだけ実行する')
+    parser.add_argument('--profile', metavar='CASE',
+                        help='ケースを cProfile で実行する')
+    parser.add_argument('--record', nargs=2, metavar=('KIND', 'URL'),
+                        help='URL のページを fixtures に保存する '
+                             '(KIND: listing / product / reviews)')
+    parser.add_argument('--parsers', action='store_true',
+                        help='bs4.diagnose.benchmark_parsers を実行する')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='通しの計測で1リクエストごとに入れる待ち時間 (ミリ秒)')
+    parser.add_argument('--cassette', metavar='DIR',
+                        help='通しの計測で fixtures の代わりに使うカセット '
+                             '(cassette.py で記録したもの)')
+    options = parser.parse_args()
+
+    if options.record:
+        record(*options.record)
+    elif options.parsers:
+        diagnose.benchmark_parsers()
+    elif options.profile:
+        profile(options.profile, options.iterations, options.cassette)
+    else:
+        result = run(options.iterations, options.only,
+                     options.latency / 1000, options.cassette)
+        if options.output:
+            with open(options.output, 'w') as f:
+                json.dump(result, f, indent=2)
+        json.dump(result, sys.stdout, indent=2)
+        print()
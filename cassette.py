@@ -0,0 +1,231 @@
+# HTTP のレスポンスの記録 (record) と再生 (replay)
+#
+# record : 実際に取得したレスポンス (ステータス, ヘッダ, ボディ) を
+#          カセット (ディレクトリ) に保存する
+# replay : ネットワークにアクセスせず，カセットからメモリの速さで返す
+#          (待ち時間を入れて，相手サーバーの遅さを再現できる)
+#
+# ボディは zlib で圧縮し，SHA-256 の名前で保存する (同じボディは1つだけ)
+#
+#   <カセット>/index.jsonl       1行に1件 (URL, ステータス, ヘッダ, ボディの名前)
+#   <カセット>/blobs/ab/abcd...  圧縮したボディ
+#
+# HTTP_CASSETTE と HTTP_CASSETTE_MODE を指定すると，http_session が使う
+#
+#   HTTP_CASSETTE=cassettes/site HTTP_CASSETTE_MODE=record \
+#       python urls.py --invoker local
+#   HTTP_CASSETTE=cassettes/site HTTP_CASSETTE_MODE=replay \
+#       HTTP_REPLAY_LATENCY_MS=50 python reviews.py --invoker local
+#
+# http_session.py と一緒にデプロイすること
+
+import hashlib
+import io
+import json
+import os
+import random
+import threading
+import time
+import zlib
+from typing import Callable, Optional, Tuple
+from requests.adapters import HTTPAdapter
+from urllib3.response import HTTPResponse
+
+RECORD = 'record'
+REPLAY = 'replay'
+
+# カセットのディレクトリと，record / replay のどちらか
+CASSETTE_PATH = os.environ.get('HTTP_CASSETTE')
+CASSETTE_MODE = os.environ.get('HTTP_CASSETTE_MODE', REPLAY)
+
+# replay で1リクエストごとに入れる待ち時間 (ミリ秒)
+# 'recorded' なら記録したときにかかった時間
+REPLAY_LATENCY_MS = os.environ.get('HTTP_REPLAY_LATENCY_MS', '0')
+
+# 待ち時間に足す 0〜この値の一様乱数 (ミリ秒)
+REPLAY_JITTER_MS = float(os.environ.get('HTTP_REPLAY_JITTER_MS', 0))
+
+# 圧縮レベル
+COMPRESS_LEVEL = 6
+
+# 記録しないヘッダ (記録するボディは展開済みなので，長さと圧縮方式は変わる)
+DROP_HEADERS = ('content-encoding', 'content-length', 'transfer-encoding')
+
+
+def request_key(method: str, url: str) -> str:
+    return method + ' ' + url
+
+
+class Cassette:
+    """
+    記録したレスポンスの集まり
+
+    記録は複数のプロセス (ドライバのワーカー) から呼ばれるので，
+    index.jsonl に1行ずつ追記する (同じ URL は後の行が優先)
+    再生したボディは展開したままメモリに持っておく
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.index_path = os.path.join(path, 'index.jsonl')
+        self.lock = threading.Lock()
+        self.bodies = {}
+        os.makedirs(os.path.join(path, 'blobs'), exist_ok=True)
+
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.index[entry['key']] = entry
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.path, 'blobs', digest[:2], digest)
+
+    def put_blob(self, body: bytes) -> str:
+        # ボディを保存して，その名前 (SHA-256) を返す
+        digest = hashlib.sha256(body).hexdigest()
+        path = self.blob_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp = '%s.%d.%d' % (path, os.getpid(), threading.get_ident())
+            with open(temp, 'wb') as f:
+                f.write(zlib.compress(body, COMPRESS_LEVEL))
+            os.replace(temp, path)
+        return digest
+
+    def get_blob(self, digest: str) -> bytes:
+        body = self.bodies.get(digest)
+        if body is None:
+            with open(self.blob_path(digest), 'rb') as f:
+                body = zlib.decompress(f.read())
+            self.bodies[digest] = body
+        return body
+
+    def record(self, method: str, url: str, status: int, headers: dict,
+               body: bytes, elapsed: float):
+        entry = {
+            'key': request_key(method, url),
+            'status': status,
+            'headers': {key: value for key, value in headers.items()
+                        if key.lower() not in DROP_HEADERS},
+            'body': self.put_blob(body),
+            'elapsed': round(elapsed, 4),
+        }
+
+        line = json.dumps(entry, ensure_ascii=False) + '\n'
+        with self.lock:
+            self.index[entry['key']] = entry
+            with open(self.index_path, 'a', encoding='utf-8') as f:
+                f.write(line)
+
+    def play(self, method: str, url: str) -> Optional[dict]:
+        # 記録したレスポンス (なければ None)
+        return self.index.get(request_key(method, url))
+
+
+def build(adapter: HTTPAdapter, request, status: int, headers: dict,
+          body: bytes):
+    # バイト列からレスポンスを作る (stream=True でも読める)
+    raw = HTTPResponse(
+        body=io.BytesIO(body),
+        headers=headers,
+        status=status,
+        preload_content=False,
+    )
+    return adapter.build_response(request, raw)
+
+
+class RecordingAdapter(HTTPAdapter):
+    # 普通に取得して，レスポンスをカセットに記録する
+
+    def __init__(self, cassette: Cassette, **kwargs):
+        super().__init__(**kwargs)
+        self.cassette = cassette
+
+    def send(self, request, **kwargs):
+        begin = time.perf_counter()
+        response = super().send(request, **kwargs)
+        body = response.content
+        elapsed = time.perf_counter() - begin
+
+        self.cassette.record(request.method, request.url,
+                             response.status_code, dict(response.headers),
+                             body, elapsed)
+        return build(self, request, response.status_code,
+                     dict(response.headers), body)
+
+
+class ReplayAdapter(HTTPAdapter):
+    """
+    ネットワークにアクセスせず，記録したレスポンスを返す
+
+        latency  : 1リクエストごとの待ち時間 (秒)
+                   None なら記録したときにかかった時間
+        jitter   : 待ち時間に足す 0〜jitter 秒の一様乱数
+        fallback : 記録がない URL -> 代わりに返す URL (なければ 404)
+
+    lookup を上書きすれば，カセット以外からも返せる
+    """
+
+    def __init__(self, cassette: Optional[Cassette] = None,
+                 latency: Optional[float] = 0.0, jitter: float = 0.0,
+                 fallback: Optional[Callable[[str], str]] = None):
+        super().__init__()
+        self.cassette = cassette
+        self.latency = latency
+        self.jitter = jitter
+        self.fallback = fallback
+
+    def lookup(self, request) -> Optional[Tuple[int, dict, bytes, float]]:
+        # (ステータス, ヘッダ, ボディ, 記録したときの所要時間)
+        entry = self.cassette.play(request.method, request.url)
+        if entry is None and self.fallback is not None:
+            entry = self.cassette.play(request.method,
+                                       self.fallback(request.url))
+        if entry is None:
+            return None
+
+        return (entry['status'], entry['headers'],
+                self.cassette.get_blob(entry['body']), entry['elapsed'])
+
+    def send(self, request, **kwargs):
+        found = self.lookup(request)
+        if found is None:
+            status, headers, body, elapsed = 404, {}, b'', 0.0
+        else:
+            status, headers, body, elapsed = found
+
+        delay = elapsed if self.latency is None else self.latency
+        delay += random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+        return build(self, request, status, headers, body)
+
+
+def parse_latency(value: str) -> Optional[float]:
+    # HTTP_REPLAY_LATENCY_MS ('recorded' または ミリ秒) -> 秒
+    if value == 'recorded':
+        return None
+    return float(value) / 1000
+
+
+def from_environment(**kwargs) -> Optional[HTTPAdapter]:
+    """
+    HTTP_CASSETTE があれば，HTTP_CASSETTE_MODE に合わせたアダプタを返す
+    kwargs は記録するときの HTTPAdapter の引数 (プールやリトライ)
+    """
+
+    if not CASSETTE_PATH:
+        return None
+
+    cassette = Cassette(CASSETTE_PATH)
+    if CASSETTE_MODE == RECORD:
+        return RecordingAdapter(cassette, **kwargs)
+    if CASSETTE_MODE == REPLAY:
+        return ReplayAdapter(cassette, parse_latency(REPLAY_LATENCY_MS),
+                             REPLAY_JITTER_MS / 1000)
+    raise ValueError('HTTP_CASSETTE_MODE must be %s or %s: %s'
+                     % (RECORD, REPLAY, CASSETTE_MODE))
@@ -0,0 +1,122 @@
+import sqlite3
+import hashlib
+import json
+import time
+from typing import List, Optional
+
+DEFAULT_PATH = 'checkpoint.sqlite'
+
+# 実行モード
+FRESH = 'fresh'              # 最初から全てやり直す
+RESUME = 'resume'            # 完了済みの URL をスキップする
+ONLY_FAILED = 'only-failed'  # 失敗した URL だけやり直す
+
+DONE = 'done'
+FAILED = 'failed'
+
+
+def payload_hash(payload) -> str:
+    # 結果の JSON から SHA-256 を計算する
+    data = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class Checkpoint:
+    """
+    クロールの進捗を SQLite に記録する
+
+    (stage, URL) ごとに1行で，完了したページは結果のハッシュと一緒に，
+    失敗したページはエラー内容と一緒に保存する．
+    ドライバが落ちても，再実行時に完了済みのページを飛ばせる．
+
+        stage  : 'products' / 'urls' / 'reviews'
+        key    : URL
+        status : 'done' / 'failed'
+        hash   : 結果の SHA-256
+        rows   : 結果の行数
+        error  : エラー内容
+    """
+
+    def __init__(self, stage: str, path: str = DEFAULT_PATH):
+        self.stage = stage
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS pages ('
+            ' stage TEXT NOT NULL,'
+            ' key TEXT NOT NULL,'
+            ' status TEXT NOT NULL,'
+            ' hash TEXT,'
+            ' rows INTEGER,'
+            ' error TEXT,'
+            ' updated REAL NOT NULL,'
+            ' PRIMARY KEY (stage, key))'
+        )
+        self.conn.commit()
+
+    def _put(self, key: str, status: str, hash: Optional[str],
+             rows: Optional[int], error: Optional[str]):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (self.stage, key, status, hash, rows, error, time.time()),
+        )
+        self.conn.commit()
+
+    def done(self, key: str, payload):
+        # 完了したページを記録
+        self._put(key, DONE, payload_hash(payload), len(payload), None)
+
+    def failed(self, key: str, error):
+        # 失敗したページを記録
+        self._put(key, FAILED, None, None, str(error))
+
+    def keys(self, status: str) -> set:
+        cur = self.conn.execute(
+            'SELECT key FROM pages WHERE stage = ? AND status = ?',
+            (self.stage, status),
+        )
+        return {row[0] for row in cur}
+
+    def reset(self):
+        # このステージの記録を全て消す
+        self.conn.execute('DELETE FROM pages WHERE stage = ?', (self.stage,))
+        self.conn.commit()
+
+    def pending(self, keys: List[str], mode: str = FRESH) -> List[str]:
+        """
+        モードに応じて，これから処理する URL を元の順番のまま返す
+
+            fresh       : 記録を消して全て
+            resume      : 完了していないもの全て
+            only-failed : 失敗したものだけ
+        """
+
+        if mode == FRESH:
+            self.reset()
+            return list(keys)
+
+        if mode == RESUME:
+            done = self.keys(DONE)
+            return [key for key in keys if key not in done]
+
+        if mode == ONLY_FAILED:
+            failed = self.keys(FAILED)
+            return [key for key in keys if key in failed]
+
+        raise ValueError('unknown mode: ' + mode)
+
+    def close(self):
+        self.conn.close()
+
+
+def add_arguments(parser):
+    # ドライバ共通のコマンドライン引数
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--resume', dest='mode', action='store_const',
+                       const=RESUME, default=FRESH,
+                       help='完了済みのページをスキップする')
+    group.add_argument('--only-failed', dest='mode', action='store_const',
+                       const=ONLY_FAILED,
+                       help='前回失敗したページだけやり直す')
+    parser.add_argument('--checkpoint', default=DEFAULT_PATH,
+                        help='チェックポイントファイル (SQLite)')
@@ -0,0 +1,262 @@
+import queue
+import time
+from collections import deque
+from typing import Callable, Iterable, Iterator, Optional, Tuple
+from retry_queue import RetryQueue
+
+# 最初に同時実行する Lambda の数
+INITIAL_WINDOW = 8
+
+# ウィンドウの下限と上限
+MIN_WINDOW = 1
+MAX_WINDOW = 32
+
+# スロットリングされたときにウィンドウに掛ける値
+DECREASE = 0.5
+
+# レイテンシが最小値のこの倍以内なら健全とみなす
+LATENCY_FACTOR = 2.0
+
+# エラー率がこれを超えている間はウィンドウを増やさない
+MAX_ERROR_RATE = 0.2
+
+# レイテンシとエラー率の指数移動平均の重み
+EWMA_ALPHA = 0.1
+
+# スロットリングされたジョブをやり直す回数
+THROTTLE_ATTEMPTS = 10
+
+# 呼び出しの結果
+OK = 'ok'
+ERROR = 'error'
+THROTTLED = 'throttled'
+
+
+class AimdController:
+    """
+    同時に実行する Lambda の数 (ウィンドウ) を AIMD で調整する
+
+    - 成功してレイテンシとエラー率が健全なら，少しずつ増やす
+      (ウィンドウ1つ分の呼び出しが終わるごとに +1)
+    - スロットリングされたら半分にする
+      減らす前に投げた呼び出しのスロットリングは数えないので，
+      同時に返ってきた複数のスロットリングで何度も減らすことはない
+
+    アカウントの同時実行数の上限を知らなくても，使える分だけ使う
+    adaptive=False ならウィンドウは initial のまま変えない
+    """
+
+    def __init__(self, initial: int = INITIAL_WINDOW,
+                 minimum: int = MIN_WINDOW, maximum: int = MAX_WINDOW,
+                 adaptive: bool = True):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.adaptive = adaptive
+        self.window = float(min(self.maximum, max(minimum, initial)))
+
+        self.in_flight = 0
+        self.completed = 0
+        self.throttles = 0
+        self.errors = 0
+
+        # コストあたりのレイテンシ (最小値と移動平均)
+        self.baseline = None
+        self.latency = None
+        self.error_rate = 0.0
+
+        self.last_decrease = float('-inf')
+        self.started = time.monotonic()
+
+        # (経過秒数, ウィンドウ) の変化の記録
+        self.timeline = [(0.0, self.limit)]
+
+    @property
+    def limit(self) -> int:
+        # 現在のウィンドウ (同時に実行してよい数)
+        return max(self.minimum, int(self.window))
+
+    def can_submit(self) -> bool:
+        return self.in_flight < self.limit
+
+    def start(self) -> float:
+        # 呼び出しを始める．finish に渡すトークン (開始時刻) を返す
+        self.in_flight += 1
+        return time.monotonic()
+
+    def finish(self, token: float, outcome: str = OK, cost: float = 1):
+        # 呼び出しの結果を記録して，ウィンドウを調整する
+        now = time.monotonic()
+        self.in_flight -= 1
+        self.completed += 1
+
+        if outcome == THROTTLED:
+            self.throttles += 1
+            if token > self.last_decrease:
+                self._resize(self.window * DECREASE)
+                self.last_decrease = now
+            return
+
+        failed = 1.0 if outcome == ERROR else 0.0
+        self.error_rate += EWMA_ALPHA * (failed - self.error_rate)
+        if outcome == ERROR:
+            self.errors += 1
+            return
+
+        latency = (now - token) / max(cost, 1)
+        if self.baseline is None or latency < self.baseline:
+            self.baseline = latency
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += EWMA_ALPHA * (latency - self.latency)
+
+        if self.healthy():
+            self._resize(self.window + 1 / self.window)
+
+    def healthy(self) -> bool:
+        return (self.error_rate <= MAX_ERROR_RATE
+                and self.latency <= self.baseline * LATENCY_FACTOR)
+
+    def _resize(self, window: float):
+        if not self.adaptive:
+            return
+
+        before = self.limit
+        self.window = min(self.maximum, max(self.minimum, window))
+        if self.limit != before:
+            self.timeline.append((time.monotonic() - self.started,
+                                  self.limit))
+
+    def average_window(self) -> float:
+        # 始めてから今までの，時間で重み付けしたウィンドウの平均
+        now = time.monotonic() - self.started
+        if now <= 0:
+            return float(self.limit)
+
+        points = self.timeline + [(now, self.limit)]
+        total = 0.0
+        for (begin, window), (end, _) in zip(points, points[1:]):
+            total += (end - begin) * window
+        return total / now
+
+    def metrics(self) -> dict:
+        windows = [window for _, window in self.timeline]
+        return {
+            'window': self.limit,
+            'window_min': min(windows),
+            'window_max': max(windows),
+            'in_flight': self.in_flight,
+            'completed': self.completed,
+            'throttles': self.throttles,
+            'errors': self.errors,
+        }
+
+    def report(self):
+        print('concurrency window: %(window)d (min %(window_min)d, '
+              'max %(window_max)d), %(completed)d calls, '
+              '%(throttles)d throttled, %(errors)d errors' % self.metrics())
+
+
+def imap_adaptive(pool, fn: Callable, jobs: Iterable,
+                  controller: AimdController,
+                  outcome: Callable[[object], str],
+                  cost: Callable[[object], float] = lambda job: 1,
+                  retries: Optional[RetryQueue] = None,
+                  follow: Optional[Callable[[object, object],
+                                            Optional[object]]] = None
+                  ) -> Iterator[Tuple[object, object]]:
+    """
+    pool.imap_unordered(fn, jobs) と同じく，終わった順に (ジョブ, 結果) を返す
+    ただし，同時に実行するジョブの数を controller のウィンドウまでにする
+
+        outcome : 結果が OK / ERROR / THROTTLED のどれか
+        cost    : ジョブの重さ (レイテンシをこれで割って比べる)
+        retries : スロットリングされたジョブのリトライキュー
+        follow  : (ジョブ, 結果) から続きのジョブを返す (なければ None)
+                  続きのジョブは，まだ投げていないジョブより先に投げる
+
+    スロットリングされたジョブは返さずに，バックオフ後にやり直す
+    (THROTTLE_ATTEMPTS 回だめなら，最後の結果を返す)
+    jobs は必要になった分だけ取り出すので，途中で止めたいならジェネレータを渡す
+    pool のワーカー数は controller.maximum 以上 (ジョブがそれより少なければ
+    ジョブの数以上) にすること
+    """
+
+    if retries is None:
+        retries = RetryQueue(max_attempts=THROTTLE_ATTEMPTS)
+
+    jobs = iter(jobs)
+    exhausted = False
+    followups = deque()
+    attempts = {}
+    results = queue.Queue()
+
+    def submit(job):
+        token = controller.start()
+        pool.apply_async(
+            fn, (job,),
+            callback=lambda result: results.put((token, job, result, None)),
+            error_callback=lambda e: results.put((token, job, None, e)))
+
+    while True:
+        # ウィンドウに空きがある間，次のジョブを投げる
+        while controller.can_submit():
+            item = retries.pop_due()
+            if item is None and followups:
+                item = (followups.popleft(), 0)
+            if item is None and not exhausted:
+                job = next(jobs, StopIteration)
+                if job is StopIteration:
+                    exhausted = True
+                else:
+                    item = (job, 0)
+            if item is None:
+                break
+
+            job, attempts[job] = item
+            submit(job)
+
+        if (controller.in_flight == 0 and len(retries) == 0 and exhausted
+                and not followups):
+            return
+
+        try:
+            token, job, result, e = results.get(timeout=retries.next_due())
+        except queue.Empty:
+            continue
+
+        if e is not None:
+            controller.finish(token, ERROR)
+            raise e
+
+        status = outcome(result)
+        controller.finish(token, status, cost(job))
+
+        if status == THROTTLED and retries.push(job, attempts[job] + 1,
+                                                 'throttled'):
+            continue
+
+        del attempts[job]
+        if follow is not None:
+            followup = follow(job, result)
+            if followup is not None:
+                followups.append(followup)
+        yield job, result
+
+
+def add_arguments(parser):
+    # ドライバ共通のコマンドライン引数
+    parser.add_argument('--concurrency', type=int, default=INITIAL_WINDOW,
+                        help='最初に同時実行する Lambda の数')
+    parser.add_argument('--max-concurrency', type=int, default=MAX_WINDOW,
+                        help='同時実行する Lambda の数の上限')
+    parser.add_argument('--fixed-concurrency', action='store_true',
+                        help='同時実行数を --concurrency のまま変えない')
+
+
+def from_arguments(options) -> AimdController:
+    if options.fixed_concurrency:
+        return AimdController(options.concurrency,
+                              maximum=options.concurrency, adaptive=False)
+    return AimdController(options.concurrency,
+                          maximum=options.max_concurrency)
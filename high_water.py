@@ -0,0 +1,60 @@
+# 前回どこまで感想を取得したか (high-water mark) を表す
+# reviews_lambda.py と一緒にデプロイすること
+#
+#   {'date': '2022/10/09', 'fingerprint': '3f5a...'}
+#
+# 感想一覧ページは新しい順に並んでいるので，この感想に当たったら
+# それより後のページは前回取得済み
+
+import hashlib
+import json
+from typing import Optional
+
+# 感想の並び: [タイトル, 性別, 年齢, 日付, 商品名, 価格, ラベル, 本文, 理由]
+DATE = 3
+PRICE = 5
+
+
+def fingerprint(review: list) -> str:
+    # 感想1件を識別する値
+    # (価格は商品一覧ページから付けた値で，変わることがあるので含めない)
+    fields = review[:PRICE] + review[PRICE + 1:]
+    data = json.dumps(fields, ensure_ascii=False).encode('utf-8')
+    return hashlib.sha1(data).hexdigest()[:16]
+
+
+def mark(reviews: list) -> Optional[dict]:
+    # 新しい順に並んだ感想から，次回の high-water mark を作る
+    if not reviews:
+        return None
+    return {'date': reviews[0][DATE], 'fingerprint': fingerprint(reviews[0])}
+
+
+def is_seen(review: list, since: dict) -> bool:
+    """
+    前回取得済みの感想かどうか
+
+    since の感想そのものか，それより古い日付なら取得済み
+    (日付は '2022/10/09' の形なので，文字列のまま比べられる)
+    """
+
+    return (review[DATE] < since['date']
+            or fingerprint(review) == since['fingerprint'])
+
+
+def new_reviews(reviews: list, since: Optional[dict]):
+    """
+    新しい順に並んだ感想から，since より新しいものだけを返す
+
+    returns:
+        (新しい感想のリスト, since に当たったかどうか)
+    """
+
+    if since is None:
+        return reviews, False
+
+    for i, review in enumerate(reviews):
+        if is_seen(review, since):
+            return reviews[:i], True
+
+    return reviews, False
@@ -0,0 +1,347 @@
+# HTTP の条件付きリクエスト (ETag / Last-Modified) のキャッシュ
+#
+# ETag / Last-Modified 付きのレスポンスはボディごと保存しておき，
+# 次は If-None-Match / If-Modified-Since を付けて取得する
+# 304 が返ってきたら保存したボディを返し，パースした結果も保存してあれば
+# パースもしない (http_session.get_parsed)
+#
+# 保存先 (Store) は get / put を持つものなら何でもよい
+#   DirectoryStore : ディレクトリ (Lambda の /tmp や EFS などの共有ボリューム)
+#   MemoryStore    : プロセス内 (ウォームスタートの間だけ)
+# どちらも合計サイズが上限を超えたら，最近使っていないものから消す
+#
+# HTTP_CACHE_DIR を指定したときだけ使う
+# http_session.py と一緒にデプロイすること
+
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+from requests.adapters import HTTPAdapter
+from urllib3.response import HTTPResponse
+
+# キャッシュを置くディレクトリ (指定しなければキャッシュしない)
+CACHE_DIR = os.environ.get('HTTP_CACHE_DIR')
+
+# 保存先の合計サイズの上限 (バイト)
+MAX_BYTES = int(os.environ.get('HTTP_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+
+# 上限を超えたら，この割合まで減らす
+# (1件ごとに消すとディレクトリの走査が増えるので，まとめて消す)
+EVICT_TO = 0.9
+
+# ボディと一緒に保存しないヘッダ
+# (保存するボディは展開済みなので，長さと圧縮方式は変わる)
+DROP_HEADERS = ('content-encoding', 'content-length', 'transfer-encoding')
+
+
+class CacheStats:
+    """
+    キャッシュのヒット数など
+    RetryStats と同じく，ハンドラの呼び出しの最初に reset する
+
+        hits          : 304 で，保存したボディを返した
+        misses        : 保存したものがなく，普通に取得した
+        revalidations : 条件付きリクエストを送った (hits + 変わっていた数)
+        parsed        : パースした結果も保存してあり，パースしなかった
+        evictions     : サイズの上限を超えて消した
+    """
+
+    KEYS = ('hits', 'misses', 'revalidations', 'parsed', 'evictions')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counts = dict.fromkeys(self.KEYS, 0)
+
+    def record(self, key: str, count: int = 1):
+        with self.lock:
+            self.counts[key] += count
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return dict(self.counts)
+
+
+CACHE_STATS = CacheStats()
+
+
+class MemoryStore:
+    # キー -> バイト列 (合計 max_bytes まで，LRU で消す)
+
+    def __init__(self, max_bytes: int = MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self.lock:
+            data = self.items.get(key)
+            if data is not None:
+                self.items.move_to_end(key)
+            return data
+
+    def put(self, key: str, data: bytes):
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.items[key] = data
+            self.size += len(data)
+
+            while self.size > self.max_bytes and len(self.items) > 1:
+                _, evicted = self.items.popitem(last=False)
+                self.size -= len(evicted)
+                CACHE_STATS.record('evictions')
+
+
+class DirectoryStore:
+    """
+    キー -> バイト列 を1件1ファイルで保存する
+
+    使うたびにファイルの更新時刻を今にして，上限を超えたら
+    更新時刻の古いものから消す (LRU)
+    共有ボリュームで複数のプロセスから使えるように，書き込みは
+    一時ファイルから rename し，他のプロセスが消したファイルは無視する
+    """
+
+    def __init__(self, path: str, max_bytes: int = MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self.size = sum(size for _, _, size in self.scan())
+
+    def file(self, key: str) -> str:
+        return os.path.join(self.path, key)
+
+    def scan(self):
+        # (更新時刻, パス, サイズ) のリスト
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.startswith('.'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, entry.path, stat.st_size))
+        return entries
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self.file(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def put(self, key: str, data: bytes):
+        path = self.file(key)
+        temp = os.path.join(self.path, '.%s.%d.%d' % (
+            key, os.getpid(), threading.get_ident()))
+        with open(temp, 'wb') as f:
+            f.write(data)
+
+        # 上書きする場合は，前のファイルの分を引く
+        try:
+            old_size = os.stat(path).st_size
+        except FileNotFoundError:
+            old_size = 0
+        os.replace(temp, path)
+
+        with self.lock:
+            self.size += len(data) - old_size
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        # 他のプロセスの書き込みもあるので，実際のサイズを数え直す
+        entries = sorted(self.scan())
+        size = sum(entry[2] for entry in entries)
+        for _, path, file_size in entries:
+            if size <= self.max_bytes * EVICT_TO:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= file_size
+            CACHE_STATS.record('evictions')
+        self.size = size
+
+
+class Entry:
+    """
+    保存した1件のレスポンス
+
+        meta : {'url', 'etag', 'last_modified', 'headers', 'parsed', 'saved'}
+               parsed は 名前 -> パースした結果 (JSON にできるもの)
+        body : 展開済みのボディ
+    """
+
+    def __init__(self, cache: 'HttpCache', meta: dict, body: bytes):
+        self.cache = cache
+        self.meta = meta
+        self.body = body
+
+    def parsed(self, name: str) -> Any:
+        return self.meta['parsed'].get(name)
+
+    def save_parsed(self, name: str, value: Any):
+        self.meta['parsed'][name] = value
+        self.cache.save(self)
+
+    def encode(self) -> bytes:
+        # 1行目にメタデータの JSON，残りがボディ
+        header = json.dumps(self.meta, ensure_ascii=False).encode('utf-8')
+        return header + b'\n' + self.body
+
+    @classmethod
+    def decode(cls, cache: 'HttpCache', data: bytes) -> 'Entry':
+        header, body = data.split(b'\n', 1)
+        return cls(cache, json.loads(header), body)
+
+
+class HttpCache:
+    # URL ごとに Entry を Store に保存する
+
+    def __init__(self, store):
+        self.store = store
+
+    @staticmethod
+    def key(url: str) -> str:
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def load(self, url: str) -> Optional[Entry]:
+        data = self.store.get(self.key(url))
+        if data is None:
+            return None
+        try:
+            entry = Entry.decode(self, data)
+        except ValueError:
+            # 書きかけなどで壊れていたら，無かったことにする
+            return None
+        # キーの衝突
+        if entry.meta['url'] != url:
+            return None
+        return entry
+
+    def save(self, entry: Entry):
+        self.store.put(self.key(entry.meta['url']), entry.encode())
+
+
+def validators(headers) -> Tuple[Optional[str], Optional[str]]:
+    # (ETag, Last-Modified)
+    return headers.get('etag'), headers.get('last-modified')
+
+
+class CachingAdapter(HTTPAdapter):
+    """
+    GET に条件付きリクエストを使う HTTPAdapter
+
+    - 保存したものがあれば If-None-Match / If-Modified-Since を付ける
+    - 304 なら，保存したボディで 200 のレスポンスを作って返す
+    - 200 で ETag / Last-Modified があれば，ボディを全て読んで保存する
+      (stream=True でも，返すレスポンスは保存したボディから読む)
+
+    返すレスポンスには from_cache (304 だったか) と
+    cache_entry (保存した Entry，保存しなかった場合は None) が付く
+    """
+
+    def __init__(self, cache: HttpCache, **kwargs):
+        super().__init__(**kwargs)
+        self.cache = cache
+
+    def send(self, request, **kwargs):
+        if request.method != 'GET':
+            return super().send(request, **kwargs)
+
+        entry = self.cache.load(request.url)
+        if entry is None:
+            CACHE_STATS.record('misses')
+        else:
+            CACHE_STATS.record('revalidations')
+            if entry.meta['etag']:
+                request.headers['If-None-Match'] = entry.meta['etag']
+            if entry.meta['last_modified']:
+                request.headers['If-Modified-Since'] = \
+                    entry.meta['last_modified']
+
+        response = super().send(request, **kwargs)
+
+        if response.status_code == 304 and entry is not None:
+            CACHE_STATS.record('hits')
+            # 304 のボディ (空) を読み切って，コネクションをプールに返す
+            # (close するとソケットが閉じ，次のリクエストで接続し直しになる)
+            response.raw.drain_conn()
+            response.raw.release_conn()
+            return self.from_entry(request, entry, True)
+
+        etag, last_modified = validators(response.headers)
+        if response.status_code != 200 or not (etag or last_modified):
+            response.from_cache = False
+            response.cache_entry = None
+            return response
+
+        headers = {key: value for key, value in response.headers.items()
+                   if key.lower() not in DROP_HEADERS}
+        meta = {
+            'url': request.url,
+            'etag': etag,
+            'last_modified': last_modified,
+            'headers': headers,
+            'parsed': {},
+            'saved': time.time(),
+        }
+        entry = Entry(self.cache, meta, response.content)
+        self.cache.save(entry)
+        return self.from_entry(request, entry, False)
+
+    def from_entry(self, request, entry: Entry, from_cache: bool):
+        raw = HTTPResponse(
+            body=io.BytesIO(entry.body),
+            headers=entry.meta['headers'],
+            status=200,
+            preload_content=False,
+        )
+        response = self.build_response(request, raw)
+        response.from_cache = from_cache
+        response.cache_entry = entry
+        return response
+
+
+def parsed(response, name: str) -> Any:
+    # 304 だったレスポンスに，以前パースした結果が保存してあれば返す
+    entry = getattr(response, 'cache_entry', None)
+    if not getattr(response, 'from_cache', False) or entry is None:
+        return None
+
+    value = entry.parsed(name)
+    if value is not None:
+        CACHE_STATS.record('parsed')
+    return value
+
+
+def save_parsed(response, name: str, value: Any):
+    # パースした結果をレスポンスと一緒に保存する (保存したレスポンスだけ)
+    entry = getattr(response, 'cache_entry', None)
+    if entry is not None:
+        entry.save_parsed(name, value)
+
+
+def from_environment() -> Optional[HttpCache]:
+    # HTTP_CACHE_DIR があればそこに保存する
+    if not CACHE_DIR:
+        return None
+    return HttpCache(DirectoryStore(CACHE_DIR, MAX_BYTES))
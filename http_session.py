@@ -0,0 +1,311 @@
+# Lambda ハンドラ共通の HTTP セッション
+#
+# モジュールレベルで作るので，同じコンテナ (ウォームスタート) の間は
+# コネクションが使い回され，ページごとの TCP + TLS ハンドシェイクがなくなる
+# 接続エラーと 429 / 5xx は，待ち時間をばらつかせながらリトライする
+# 相手サーバーが応答しなくなっても，TIMEOUT でタイムアウトしてリトライする
+# HTTP_CACHE_DIR を指定すると，条件付きリクエストでキャッシュする (http_cache.py)
+# HTTP_CASSETTE を指定すると，レスポンスを記録・再生する (cassette.py)
+# 各ハンドラのデプロイパッケージに一緒に入れること
+
+import codecs
+import os
+import random
+import threading
+import time
+from itertools import takewhile
+from typing import Any, Callable, Iterator, Optional, Tuple
+from urllib.parse import urlsplit
+import requests
+import cassette
+import http_cache
+from requests.adapters import HTTPAdapter
+from requests.utils import _parse_content_type_header
+from urllib3.util.retry import Retry
+
+# コネクションプールを持つホストの数
+POOL_CONNECTIONS = 4
+
+# 1ホストあたりに保持するコネクション数
+POOL_MAXSIZE = 16
+
+# 接続と読み込みのタイムアウト (秒)
+# 読み込みは1回の受信ごと (応答が止まったら ReadTimeoutError でリトライする)
+# タイムアウトがないと，止まったソケットを Lambda の制限時間まで待ち続ける
+CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 3.05))
+READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 10))
+TIMEOUT = (CONNECT_TIMEOUT, READ_TIMEOUT)
+
+# 受信しながらパーサに渡すときのチャンクサイズ (バイト)
+CHUNK_SIZE = 16 * 1024
+
+# リトライするステータスコード
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# 1リクエストあたりのリトライ回数
+MAX_RETRIES = 3
+
+# n 回目のリトライの前に，0〜BACKOFF_FACTOR * 2^(n-1) 秒待つ
+BACKOFF_FACTOR = 0.5
+
+# 待ち時間の上限 (秒)
+# Retry-After がこれより長くても，Lambda の制限時間があるのでここまでにする
+BACKOFF_MAX = 10.0
+
+# 既知の文字コード
+# 指定すると，ヘッダに charset がなくても文字コード判定をしない
+KNOWN_ENCODING = os.environ.get('HTML_ENCODING')
+
+# ホスト -> 文字コード
+# 判定 (charset_normalizer) はホストごとに1回だけ行い，以降は使い回す
+HOST_ENCODINGS = {}
+
+
+class RetryStats:
+    """
+    HTTP のリトライの回数と待ち時間
+    ハンドラの呼び出しの最初に reset して，レスポンスに to_dict を入れる
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.retries = 0
+            self.delay = 0.0
+            self.statuses = {}
+
+    def record(self, status: Optional[int], delay: float):
+        # status はリトライの原因のステータスコード (接続エラーなら None)
+        key = str(status) if status else 'error'
+        with self.lock:
+            self.retries += 1
+            self.delay += delay
+            self.statuses[key] = self.statuses.get(key, 0) + 1
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                'retries': self.retries,
+                'delay': round(self.delay, 3),
+                'statuses': dict(self.statuses),
+            }
+
+
+RETRY_STATS = RetryStats()
+
+
+class JitterRetry(Retry):
+    """
+    urllib3 の Retry に，ジッターと RETRY_STATS への記録を加えたもの
+
+    - Retry-After があればそれに従う (BACKOFF_MAX まで)
+    - なければ 0〜min(BACKOFF_MAX, backoff_factor * 2^(n-1)) 秒の一様乱数
+      (同じページを同時に取得しているスレッドのリトライがばらける)
+    """
+
+    def get_backoff_time(self) -> float:
+        # リダイレクトを除いて，続けて失敗した回数
+        errors = len(list(takewhile(lambda x: x.redirect_location is None,
+                                    reversed(self.history))))
+        if errors == 0:
+            return 0
+
+        return random.uniform(
+            0, min(BACKOFF_MAX, self.backoff_factor * 2 ** (errors - 1)))
+
+    def sleep(self, response=None):
+        delay = None
+        if self.respect_retry_after_header and response:
+            delay = self.get_retry_after(response)
+
+        if delay:
+            delay = min(BACKOFF_MAX, delay)
+        else:
+            delay = self.get_backoff_time()
+
+        RETRY_STATS.record(response.status if response else None, delay)
+        if delay > 0:
+            time.sleep(delay)
+
+
+def new_retry(total: int = MAX_RETRIES,
+              backoff_factor: float = BACKOFF_FACTOR) -> Retry:
+    # 接続エラーと RETRY_STATUSES をリトライする (GET / HEAD のみ)
+    return JitterRetry(
+        total=total,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset(['GET', 'HEAD']),
+        backoff_factor=backoff_factor,
+        respect_retry_after_header=True,
+    )
+
+
+def max_request_seconds(timeout: Tuple[float, float] = TIMEOUT,
+                        retries: int = MAX_RETRIES) -> float:
+    """
+    1リクエストが，リトライを含めて最も長くかかる時間 (秒)
+
+    全ての試行が接続と読み込みの両方でタイムアウトし，
+    毎回 BACKOFF_MAX だけ待った場合
+    (ボディの受信は1回ごとに READ_TIMEOUT なので，1ページの大きさなら
+     ほぼこの中に収まる)
+    """
+
+    connect, read = timeout
+    return (retries + 1) * (connect + read) + retries * BACKOFF_MAX
+
+
+class TimeoutSession(requests.Session):
+    # timeout を指定しないリクエストには，セッションの timeout を使う
+
+    def __init__(self, timeout: Tuple[float, float] = TIMEOUT):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+def new_session(pool_connections: int = POOL_CONNECTIONS,
+                pool_maxsize: int = POOL_MAXSIZE,
+                max_retries: Optional[Retry] = None,
+                cache: Optional[http_cache.HttpCache] = None,
+                timeout: Tuple[float, float] = TIMEOUT
+                ) -> requests.Session:
+    """
+    keep-alive するコネクションプール付きのセッションを作る
+    max_retries を省略すると new_retry() でリトライする
+    timeout を指定しないリクエストは timeout (接続, 読み込み) 秒で打ち切る
+    cache を渡すと，GET を条件付きリクエストにしてキャッシュする
+    HTTP_CASSETTE があれば，キャッシュの代わりに記録・再生する
+    """
+
+    if max_retries is None:
+        max_retries = new_retry()
+
+    kwargs = dict(pool_connections=pool_connections,
+                  pool_maxsize=pool_maxsize,
+                  max_retries=max_retries)
+    adapter = cassette.from_environment(**kwargs)
+    if adapter is None and cache is None:
+        adapter = HTTPAdapter(**kwargs)
+    elif adapter is None:
+        adapter = http_cache.CachingAdapter(cache, **kwargs)
+
+    session = TimeoutSession(timeout)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+# HTTP_CACHE_DIR がなければ None (キャッシュしない)
+CACHE = http_cache.from_environment()
+
+SESSION = new_session(cache=CACHE)
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return SESSION.get(url, **kwargs)
+
+
+def declared_encoding(res: requests.Response) -> Optional[str]:
+    # Content-Type ヘッダの charset
+    content_type = res.headers.get('content-type')
+    if not content_type:
+        return None
+
+    _, params = _parse_content_type_header(content_type)
+    charset = params.get('charset')
+    if not charset or charset is True:
+        return None
+
+    return charset.strip('\'"')
+
+
+def known_encoding(res: requests.Response) -> Optional[str]:
+    """
+    判定せずに分かる文字コードを返す
+
+        1. Content-Type ヘッダの charset
+        2. KNOWN_ENCODING
+        3. 同じホストで以前に判定した文字コード
+    """
+
+    encoding = declared_encoding(res) or KNOWN_ENCODING
+    if encoding:
+        return encoding
+
+    return HOST_ENCODINGS.get(urlsplit(res.url).netloc)
+
+
+def remember_encoding(url: str, encoding: Optional[str]):
+    # 判定した文字コードをホストごとに覚えておく
+    if encoding:
+        HOST_ENCODINGS[urlsplit(url).netloc] = encoding
+
+
+def iter_text(url: str, chunk_size: int = CHUNK_SIZE,
+              **kwargs) -> Iterator[str]:
+    """
+    レスポンスを受信しながら，少しずつ文字列にして返す
+    (文字コードは known_encoding()，分からなければ1回だけ判定する)
+
+    ボディ全体を持たないので，受信とパースを重ねられ，
+    メモリもチャンクサイズ分しか使わない
+    途中で打ち切られた場合は残りを読み捨てて，コネクションをプールに返す
+    """
+
+    res = SESSION.get(url, stream=True, **kwargs)
+    yield from iter_response_text(res, chunk_size)
+
+
+def iter_response_text(res: requests.Response,
+                       chunk_size: int = CHUNK_SIZE) -> Iterator[str]:
+    # iter_text と同じ (stream=True で取得したレスポンスを渡す)
+    try:
+        encoding = known_encoding(res)
+        if encoding is None:
+            # 文字コードが分からない場合は全て読んでから判定する
+            encoding = res.apparent_encoding
+            remember_encoding(res.url, encoding)
+            yield str(res.content, encoding or 'utf-8', errors='replace')
+            return
+
+        decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+        for chunk in res.raw.stream(chunk_size, decode_content=True):
+            text = decoder.decode(chunk)
+            if text:
+                yield text
+
+        text = decoder.decode(b'', final=True)
+        if text:
+            yield text
+
+    finally:
+        res.raw.drain_conn()
+        res.raw.release_conn()
+
+
+def get_parsed(url: str, name: str,
+               parse: Callable[[requests.Response], Any], **kwargs) -> Any:
+    """
+    url のレスポンスを parse した結果を返す (stream=True で取得する)
+
+    HTTP キャッシュで 304 が返り，以前 name でパースした結果が
+    保存してあれば，パースせずにそれを返す
+    結果は保存するので，JSON にできるもの (行のリストなど) にすること
+    """
+
+    res = SESSION.get(url, stream=True, **kwargs)
+    value = http_cache.parsed(res, name)
+    if value is not None:
+        res.close()
+        return value
+
+    value = parse(res)
+    http_cache.save_parsed(res, name, value)
+    return value
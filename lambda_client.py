@@ -0,0 +1,213 @@
+import importlib
+import json
+import time
+from multiprocessing import Array, Pool
+from multiprocessing.pool import ThreadPool
+
+# 1クライアントあたりの HTTP コネクション数 (同時実行数以上にする)
+MAX_POOL_CONNECTIONS = 10
+
+# ローカル実行で context に渡す制限時間 (ミリ秒)
+LOCAL_TIMEOUT_MS = 15 * 60 * 1000
+
+# 呼び出す Lambda の制限時間 (秒)
+# reviews は制限時間の近くまで実行するので，応答を待つ時間はこれより長くする
+FUNCTION_TIMEOUT = 15 * 60
+
+# 応答を待つ時間に足す余裕 (秒)
+READ_TIMEOUT_MARGIN = 30
+
+# 呼び出し先
+AWS = 'aws'      # AWS Lambda を呼び出す
+LOCAL = 'local'  # *_lambda.py の lambda_handler をこのプロセスで直接呼ぶ
+BACKENDS = (AWS, LOCAL)
+
+# スロットリング (同時実行数やリクエスト数の上限) を表すエラーコード
+THROTTLE_CODES = ('TooManyRequestsException', 'ThrottlingException')
+
+# プロセスごとに1つだけ作る Invoker
+_invoker = None
+
+# クライアント作成と invoke の所要時間
+# [作成回数, 作成時間(秒), invoke 回数, invoke 時間(秒)]
+_stats = None
+
+
+class AwsInvoker:
+    """
+    boto3 の Lambda クライアントで呼び出す
+
+    クライアントはスレッドセーフなので，スレッド間では共有してよい
+    (セッションは共有できないので専用のものを作る)
+
+    botocore のリトライはしない (1回だけ呼び出す)
+    - 読み込みのタイムアウトでリトライすると，元の呼び出しが実行中のまま
+      同じ Lambda をもう一度実行してしまう
+    - スロットリングをすぐに呼び出し側に返し，同時実行数の調整と
+      ドライバのリトライキューに任せる
+    """
+
+    def __init__(self, max_pool_connections: int = MAX_POOL_CONNECTIONS,
+                 read_timeout: float = FUNCTION_TIMEOUT + READ_TIMEOUT_MARGIN):
+        import boto3
+        from botocore.config import Config
+
+        session = boto3.session.Session()
+        self.client = session.client(
+            'lambda',
+            config=Config(max_pool_connections=max_pool_connections,
+                          read_timeout=read_timeout,
+                          retries={'mode': 'standard',
+                                   'total_max_attempts': 1}),
+        )
+
+    def invoke(self, fun: str, payload: object) -> str:
+        response = self.client.invoke(
+            FunctionName=fun,
+            InvocationType='RequestResponse',
+            Payload=json.dumps(payload).encode('utf-8'),
+        )
+        return response['Payload'].read().decode('utf-8')
+
+
+class LocalContext:
+    # Lambda の context の代わり (残り時間だけ返す)
+
+    def __init__(self, function_name: str, timeout_ms: int = LOCAL_TIMEOUT_MS):
+        self.function_name = function_name
+        self.deadline = time.monotonic() + timeout_ms / 1000
+
+    def get_remaining_time_in_millis(self) -> int:
+        return max(0, int((self.deadline - time.monotonic()) * 1000))
+
+
+class LocalInvoker:
+    """
+    関数名 fun に対応する fun_lambda.py の lambda_handler を直接呼ぶ
+    (products -> products_lambda.lambda_handler)
+
+    AWS もネットワーク越しの JSON のやり取りもいらないので，
+    1台のマシンでパイプライン全体の計測や負荷試験ができる
+    レスポンスは Lambda と同じく JSON 文字列にして返す
+    """
+
+    def __init__(self, timeout_ms: int = LOCAL_TIMEOUT_MS):
+        self.timeout_ms = timeout_ms
+        self.handlers = {}
+
+    def handler(self, fun: str):
+        if fun not in self.handlers:
+            module = importlib.import_module(fun + '_lambda')
+            self.handlers[fun] = module.lambda_handler
+        return self.handlers[fun]
+
+    def invoke(self, fun: str, payload: object) -> str:
+        # 本番と同じく，イベントは JSON を通したものを渡す
+        event = json.loads(json.dumps(payload))
+        context = LocalContext(fun, self.timeout_ms)
+        result = self.handler(fun)(event, context)
+
+        # bytes は UTF-8 の文字列として書き出す
+        return json.dumps(result, default=lambda b: b.decode('utf-8'))
+
+
+def new_stats():
+    # プロセス間で共有できる計測用の配列
+    return Array('d', 4)
+
+
+def init_client(max_pool_connections: int = MAX_POOL_CONNECTIONS,
+                stats=None, backend: str = AWS):
+    """
+    Invoker を作成する
+    Pool の initializer に渡すと，ワーカープロセスごとに1回だけ呼ばれる
+    """
+
+    global _invoker, _stats
+    _stats = stats
+
+    start = time.perf_counter()
+    if backend == LOCAL:
+        _invoker = LocalInvoker()
+    elif backend == AWS:
+        _invoker = AwsInvoker(max_pool_connections)
+    else:
+        raise ValueError('unknown backend: ' + backend)
+    _record(0, time.perf_counter() - start)
+
+
+def new_pool(workers: int, max_pool_connections: int = MAX_POOL_CONNECTIONS,
+             stats=None, backend: str = AWS):
+    """
+    Lambda を並行して呼び出すプール (apply_async / imap が使える)
+
+    aws   : 1つのクライアントを共有するスレッドのプール
+            (呼び出し中は待つだけなので，プロセスもクライアントも1つでよい)
+    local : ハンドラをこのマシンで実行するので，GIL を避けてプロセスのプール
+            (ワーカープロセスごとに Invoker を1つだけ作る)
+    """
+
+    max_pool_connections = max(max_pool_connections, workers)
+    if backend == AWS:
+        init_client(max_pool_connections, stats, backend)
+        return ThreadPool(workers)
+
+    return Pool(workers, initializer=init_client,
+                initargs=(max_pool_connections, stats, backend))
+
+
+def _record(index: int, seconds: float):
+    if _stats is None:
+        return
+
+    with _stats.get_lock():
+        _stats[index] += 1
+        _stats[index + 1] += seconds
+
+
+def invoke(fun: str, payload: object) -> str:
+    # Lambda を同期呼び出しして，レスポンスの文字列を返す
+    if _invoker is None:
+        init_client()
+
+    start = time.perf_counter()
+    decoded = _invoker.invoke(fun, payload)
+    _record(2, time.perf_counter() - start)
+
+    return decoded
+
+
+def is_throttled(error) -> bool:
+    """
+    エラーがスロットリングによるものか
+    プロセス間で受け渡すと例外は文字列になるので，どちらでも判定できる
+
+        "An error occurred (TooManyRequestsException) when calling ..."
+    """
+
+    response = getattr(error, 'response', None)
+    if isinstance(response, dict):
+        return response.get('Error', {}).get('Code') in THROTTLE_CODES
+
+    return any('(%s)' % code in str(error) for code in THROTTLE_CODES)
+
+
+def report(stats):
+    # クライアント作成と invoke の平均所要時間を表示
+    clients, client_sec, invokes, invoke_sec = stats[:]
+    if clients > 0:
+        print('client construction: %d times, avg %.1f ms'
+              % (clients, client_sec / clients * 1000))
+    if invokes > 0:
+        print('invoke: %d times, avg %.1f ms'
+              % (invokes, invoke_sec / invokes * 1000))
+
+
+def add_arguments(parser):
+    # ドライバ共通のコマンドライン引数
+    parser.add_argument('--max-pool-connections', type=int,
+                        default=MAX_POOL_CONNECTIONS,
+                        help='Lambda クライアントの最大コネクション数')
+    parser.add_argument('--invoker', choices=BACKENDS, default=AWS,
+                        help='aws: AWS Lambda を呼び出す / '
+                             'local: ハンドラをローカルで直接実行する')
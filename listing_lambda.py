@@ -0,0 +1,103 @@
+# 商品一覧ページを1回だけ取得・パースして，
+# products_lambda と urls_lambda の両方の結果を返す Lambda
+# products_lambda.py, urls_lambda.py と一緒にデプロイすること
+
+import json
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import http_cache
+import http_session
+import products_lambda
+import urls_lambda
+
+
+def is_product_card(card) -> bool:
+    # products_lambda.CARD_STRAINER と同じ条件
+    # (class がちょうど card-product の div)
+    return card.name == 'div' and card.get('class') == ['card-product']
+
+
+def find_listing(url: str) -> dict:
+    """
+    1つの商品一覧ページから，商品と感想一覧ページを取得
+
+    returns:
+
+        {'products': [[商品名, 値段, 感想数, URL], ...],
+         'urls': [[商品の値段, 感想一覧ページのURL, 最大ページ数, 感想数], ...]}
+
+    それぞれ products_lambda / urls_lambda の find_reviews_urls と同じ
+    """
+
+    # 商品一覧ページが変わっていなければ (304)，前回パースした結果を使う
+    return http_session.get_parsed(url, 'listing',
+                                   partial(parse_listing, url))
+
+
+def parse_listing(url: str, res) -> dict:
+    # urls_lambda と同じく，商品カードを全てパースする
+    soup = urls_lambda.parse_response(res, urls_lambda.CARD_STRAINER)
+    cards = soup.select('.card-product')
+
+    # 感想がない商品などは除く
+    urls = [row for row in map(urls_lambda.parse_card, cards)
+            if row is not None]
+
+    # 31番目以降は下部の「最近見たお礼の品」なので除外
+    product_cards = [card for card in cards if is_product_card(card)]
+    product_cards = product_cards[:products_lambda.CARDS_PER_PAGE]
+    products = products_lambda.parse_cards(url, product_cards)
+
+    return {'products': products, 'urls': urls}
+
+
+def find_page(url: str) -> dict:
+    # 1ページ分の結果 (失敗した場合はエラー) を返す
+    try:
+        return {'url': url, 'body': find_listing(url)}
+    except Exception as e:
+        print(url, e)
+        return {'url': url, 'error': str(e)}
+
+
+def lambda_handler(event, context):
+    """
+    商品一覧ページから，商品と感想一覧ページを取得する
+
+    event:
+        url  : 商品一覧ページのURL
+        urls : 商品一覧ページのURLのリスト (まとめて処理する場合)
+
+    returns:
+        products_lambda と同じ形式で，body が
+        {'products': [...], 'urls': [...]} になる
+        http_cache : HTTP キャッシュのヒット数など
+    """
+
+    http_session.RETRY_STATS.reset()
+    http_cache.CACHE_STATS.reset()
+
+    if 'urls' in event:
+        with ThreadPoolExecutor(
+                max_workers=products_lambda.PAGE_WORKERS) as executor:
+            results = list(executor.map(find_page, event['urls']))
+
+        return {'statusCode': 200, 'results': results,
+                'http_retries': http_session.RETRY_STATS.to_dict(),
+                'http_cache': http_cache.CACHE_STATS.to_dict()}
+
+    url = event["url"]
+    response = {'statusCode': 200}
+
+    try:
+        body = find_listing(url)
+        response['body'] = json.dumps(body)
+    except Exception as e:
+        print(e)
+        response['error'] = json.dumps(str(e))
+    finally:
+        response['url'] = url
+        response['http_retries'] = http_session.RETRY_STATS.to_dict()
+        response['http_cache'] = http_cache.CACHE_STATS.to_dict()
+
+    return response
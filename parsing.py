@@ -0,0 +1,84 @@
+# Lambda ハンドラ共通の HTML パーサ
+#
+# BeautifulSoup(html, 'html.parser') と同じ木を作るが，
+# - parse_only (SoupStrainer) にマッチした要素の部分木だけを作る
+# - マッチした要素が limit 個閉じたら，残りの HTML は読まずに打ち切る
+# ことができる
+# 各ハンドラのデプロイパッケージに一緒に入れること
+
+from typing import Iterable, Optional, Union
+from bs4 import BeautifulSoup, SoupStrainer, UnicodeDammit
+from bs4.builder._htmlparser import BeautifulSoupHTMLParser
+
+# 一度にパーサに渡す文字数
+CHUNK_SIZE = 16 * 1024
+
+
+def split(markup: str, size: int = CHUNK_SIZE) -> Iterable[str]:
+    for i in range(0, len(markup), size):
+        yield markup[i:i + size]
+
+
+def closed_count(soup: BeautifulSoup) -> int:
+    # parse_only にマッチして，閉じタグまで読み終わった要素の数
+    # (マッチした要素はルート直下に並び，読みかけの要素は tagStack に残る)
+    count = len(soup.contents)
+    if len(soup.tagStack) > 1:
+        count -= 1
+    return count
+
+
+def parse(markup: Union[str, bytes, Iterable[str]],
+          parse_only: Optional[SoupStrainer] = None,
+          limit: Optional[int] = None,
+          from_encoding: Optional[str] = None) -> BeautifulSoup:
+    """
+    HTML から BeautifulSoup を作る
+
+        markup     : HTML (str / bytes / str のチャンクの iterable)
+                     http_session.iter_text() を渡すと受信しながらパースする
+        parse_only : この条件にマッチする要素だけ木にする
+        limit      : マッチした要素がこの数だけ閉じたら打ち切る
+        from_encoding : bytes の文字コード (分かっていれば判定しない)
+
+    bytes の場合，使った文字コードは soup.original_encoding に入る
+    """
+
+    original_encoding = None
+    if isinstance(markup, bytes):
+        # 文字コードは BeautifulSoup(from_encoding=...) と同じ方法で決める
+        known = [from_encoding] if from_encoding else []
+        dammit = UnicodeDammit(markup, known, is_html=True)
+        markup = dammit.unicode_markup
+        original_encoding = dammit.original_encoding
+
+    if isinstance(markup, str):
+        markup = split(markup)
+
+    soup = BeautifulSoup('', 'html.parser', parse_only=parse_only)
+    soup.reset()
+    soup.builder.initialize_soup(soup)
+
+    args, kwargs = soup.builder.parser_args
+    parser = BeautifulSoupHTMLParser(*args, **kwargs)
+    parser.soup = soup
+
+    for chunk in markup:
+        parser.feed(chunk)
+        if limit is not None and closed_count(soup) >= limit:
+            break
+    else:
+        parser.close()
+
+    # 受信中のレスポンスなら，ここで読み終わりにする
+    if hasattr(markup, 'close'):
+        markup.close()
+
+    # 閉じていないタグを閉じる
+    soup.endData()
+    while soup.currentTag.name != soup.ROOT_TAG_NAME:
+        soup.popTag()
+
+    soup.builder.soup = None
+    soup.original_encoding = original_encoding
+    return soup
@@ -0,0 +1,130 @@
+# Lambda のレスポンスの body の形式
+#
+# 同期呼び出しのレスポンスは 6 MB までなので，感想の多い商品でも
+# 超えないようにする
+#
+#   {'encoding': 'json', 'data': [...]}            そのまま (小さい場合)
+#   {'encoding': 'zlib+base64', 'data': '...'}     JSON を zlib で圧縮して base64
+#   {'encoding': 'zlib', 'blob': '...'}            圧縮しても大きい場合は
+#                                                  BlobStore に置いて名前だけ返す
+#
+# body はレスポンスの JSON にそのまま入るので，呼び出し側の JSON の
+# デコードは1回で済む (body を JSON 文字列にして入れると2回になる)
+#
+# BlobStore はローカルのディレクトリ (PAYLOAD_BLOB_DIR) を S3 の代わりに使う
+# get / put / delete を持つものなら差し替えられる
+# reviews_lambda.py と一緒にデプロイすること
+
+import base64
+import hashlib
+import json
+import os
+import zlib
+from typing import Any, Optional
+
+JSON = 'json'
+ZLIB_BASE64 = 'zlib+base64'
+ZLIB = 'zlib'
+
+# これより大きい JSON は圧縮する (バイト)
+COMPRESS_MIN_BYTES = int(os.environ.get('PAYLOAD_COMPRESS_MIN_BYTES',
+                                        64 * 1024))
+
+# これより大きい body は BlobStore に置く (バイト)
+# (Lambda の 6 MB から，レスポンスの他の部分の分を残す)
+MAX_INLINE_BYTES = int(os.environ.get('PAYLOAD_MAX_INLINE_BYTES',
+                                      5 * 1024 * 1024))
+
+# BlobStore のディレクトリ (指定しなければ，大きくてもそのまま返す)
+BLOB_DIR = os.environ.get('PAYLOAD_BLOB_DIR')
+
+# 圧縮レベル
+COMPRESS_LEVEL = 6
+
+
+class DirectoryBlobStore:
+    # 名前 -> バイト列 を1件1ファイルで保存する (S3 の代わり)
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def put(self, key: str, data: bytes):
+        path = os.path.join(self.path, key)
+        temp = '%s.%d' % (path, os.getpid())
+        with open(temp, 'wb') as f:
+            f.write(data)
+        os.replace(temp, path)
+
+    def get(self, key: str) -> bytes:
+        with open(os.path.join(self.path, key), 'rb') as f:
+            return f.read()
+
+    def delete(self, key: str):
+        try:
+            os.remove(os.path.join(self.path, key))
+        except FileNotFoundError:
+            pass
+
+
+def default_store() -> Optional[DirectoryBlobStore]:
+    # PAYLOAD_BLOB_DIR があればそこに置く
+    if not BLOB_DIR:
+        return None
+    return DirectoryBlobStore(BLOB_DIR)
+
+
+def encode(obj: Any, store=None) -> dict:
+    """
+    obj (JSON にできるもの) を body にする
+
+    小さければそのまま，COMPRESS_MIN_BYTES を超えたら圧縮し，
+    それでも MAX_INLINE_BYTES を超えたら store に置く
+    """
+
+    data = json.dumps(obj, ensure_ascii=False).encode('utf-8')
+    if len(data) <= COMPRESS_MIN_BYTES:
+        return {'encoding': JSON, 'data': obj}
+
+    compressed = zlib.compress(data, COMPRESS_LEVEL)
+    text = base64.b64encode(compressed).decode('ascii')
+    if len(text) <= MAX_INLINE_BYTES:
+        return {'encoding': ZLIB_BASE64, 'data': text}
+
+    if store is None:
+        print('payload is too large and no blob store:', len(text), 'bytes')
+        return {'encoding': ZLIB_BASE64, 'data': text}
+
+    key = hashlib.sha256(compressed).hexdigest()
+    store.put(key, compressed)
+    return {'encoding': ZLIB, 'blob': key}
+
+
+def decode(body: Any, store=None) -> Any:
+    """
+    encode した body を元に戻す
+    store に置いた場合は，読んだら消す
+
+    以前の形式 (JSON 文字列の body) もそのまま読める
+    """
+
+    if isinstance(body, (str, bytes)):
+        return json.loads(body)
+
+    encoding = body['encoding']
+    if encoding == JSON:
+        return body['data']
+
+    if encoding == ZLIB_BASE64:
+        data = zlib.decompress(base64.b64decode(body['data']))
+        return json.loads(data)
+
+    if encoding == ZLIB:
+        if store is None:
+            raise ValueError('payload is in the blob store, '
+                             'but PAYLOAD_BLOB_DIR is not set')
+        data = zlib.decompress(store.get(body['blob']))
+        store.delete(body['blob'])
+        return json.loads(data)
+
+    raise ValueError('unknown payload encoding: %s' % encoding)
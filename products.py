@@ -1,19 +1,30 @@
 from bs4 import BeautifulSoup
-import urllib
+import urllib.request
 from urllib.parse import urljoin
-import boto3
 from botocore.exceptions import ClientError
 import json
+import os
+import lambda_client
 from typing import List
-import csv
-from multiprocessing import Pool
-from itertools import chain
-import math
-import time
-
-DOMAIN = 'https://www.furusato-tax.jp'
+import asyncio
+from concurrent.futures import Executor, ThreadPoolExecutor, \
+    ProcessPoolExecutor
+import argparse
+import checkpoint
+from checkpoint import Checkpoint
+from retry_queue import RetryQueue
+import result_writer
+from functools import partial
+import concurrency
+from concurrency import AimdController
+
+# ORIGIN_DOMAIN を指定すると，ローカルの代替サーバーなどに向けられる
+DOMAIN = os.environ.get('ORIGIN_DOMAIN', 'https://www.furusato-tax.jp')
 ROOT_URL = urljoin(DOMAIN, 'search?sort=11')
 
+# リトライ待ちのページしかないときに，ワーカーが様子を見る間隔 (秒)
+POLL_INTERVAL = 0.1
+
 
 # URLからHTMLを返す
 def fetch_html(url):
@@ -21,66 +32,100 @@ def fetch_html(url):
     return BeautifulSoup(res, 'html.parser')
 
 
-# Lambda を呼び出す
+# Lambda を呼び出す (クライアントは全スレッドで共有)
 def invoke_lambda(fun: str, payload: object):
-    client = boto3.client('lambda')
-    response = client.invoke(
-        FunctionName=fun,
-        InvocationType='RequestResponse',
-        Payload=json.dumps(payload).encode('utf-8'),
-    )
-    return response['Payload'].read().decode('utf-8')
+    return lambda_client.invoke(fun, payload)
 
 
-def get_products(url: str, retry=0):
-    """
-    商品の情報をリスト形式で取得
-    失敗した場合は5秒休んでリトライする
-    5回リトライしてだめなら，htmlを保存して諦める
+# リトライしてもだめだったページの HTML を保存する
+def save_html(url: str):
+    # TODO: save html
+    print('RETRY LIMIT SAVING HTML', url)
+    html = fetch_html(url)
+    with open(url.replace('/', '_').replace(':', '_') + '.txt', 'w') as f:
+        f.write(str(html))
 
-       [[商品名, 値段，感想数],
-        [商品名, 値段，感想数], ...]
 
+def get_products(url: str, fun_name: str = 'products'):
     """
+    商品の情報をリスト形式で取得 (Lambda を1回だけ呼び出す)
+    失敗してもリトライはせず，エラーを返す (リトライは crawl が行う)
+    fun_name='listing' なら {'products': [...], 'urls': [...]} を返す
 
-    if retry >= 5:
-        # TODO: save html
-        print('RETRY LIMIT SAVING HTML', url)
-        html = fetch_html(url)
-        with open(url.replace('/', '_').replace(':', '_') + '.txt', 'w') as f:
-            f.write(str(html))
+    returns:
+        ([[商品名, 値段，感想数, URL],
+          [商品名, 値段，感想数, URL], ...], None)
+        失敗した場合は (None, エラー)
 
-        return []
+    """
 
-    fun_name = 'products'
     payload = {
         "url": url,
     }
 
+    # どんな失敗でもエラーとして返し，リトライキューに任せる
+    # (例外を投げるとクロール全体が止まる)
     try:
         result = invoke_lambda(fun_name, payload)
         data = json.loads(result)
 
         if 'body' in data:
-            return json.loads(data['body'])
+            return json.loads(data['body']), None
 
         elif 'error' in data:
-            print('RETRY', data['url'], data['error'])
-            time.sleep(5)
-
-            return get_products(url, retry=retry+1)
+            return None, str(data['error'])
 
         else:
-            print('RETRY Unexpected', data, url)
-            time.sleep(5)
+            return None, 'Unexpected ' + str(data)
+
+    except ClientError as e:
+        return None, 'ClientError ' + str(e)
+
+    except Exception as e:
+        return None, '%s %s' % (type(e).__name__, e)
+
+
+def get_products_batch(urls: List[str], fun_name: str = 'products') -> dict:
+    """
+    複数の商品一覧ページを1回の Lambda 呼び出しでまとめて取得
+    失敗してもリトライはせず，ページごとにエラーを返す
 
-            return get_products(url, retry=retry+1)
+       {URL: ([[商品名, 値段，感想数, URL], ...], None),
+        URL: (None, エラー), ...}
+
+    """
+
+    try:
+        result = invoke_lambda(fun_name, {"urls": urls})
+        data = json.loads(result)
 
     except ClientError as e:
-        print('RETRY ClientError', url, e)
-        time.sleep(5)
+        return {url: (None, 'ClientError ' + str(e)) for url in urls}
+
+    except Exception as e:
+        return {url: (None, '%s %s' % (type(e).__name__, e)) for url in urls}
+
+    if 'results' not in data:
+        return {url: (None, 'Unexpected ' + str(data)) for url in urls}
+
+    results = {url: (None, 'missing in response') for url in urls}
+    for page in data['results']:
+        if 'body' in page:
+            results[page['url']] = (page['body'], None)
+        else:
+            results[page['url']] = (None, str(page.get('error')))
+
+    return results
+
 
-        return get_products(url, retry=retry+1)
+def batch_outcome(results: dict) -> str:
+    # 1回の呼び出しが成功 / 失敗 / スロットリングのどれか
+    errors = [error for _, error in results.values() if error is not None]
+    if any(lambda_client.is_throttled(error) for error in errors):
+        return concurrency.THROTTLED
+    if errors and len(errors) == len(results):
+        return concurrency.ERROR
+    return concurrency.OK
 
 
 # 商品一覧ページの最大ページ数を抽出
@@ -110,7 +155,178 @@ def generate_products_urls(max_pages: int) -> List[str]:
     return urls
 
 
+async def crawl(urls: List[str], controller: AimdController, writer,
+                ckpt: Checkpoint, batch_size: int = 1,
+                executor: Executor = None,
+                retries: RetryQueue = None,
+                fun_name: str = 'products') -> RetryQueue:
+    """
+    商品一覧ページを並行してクロールし，結果を writer に書き込む
+    (writer は result_writer.open_writer で作る)
+
+    - キューから URL を取り出すワーカーを controller.maximum 個走らせる
+    - 1つ終わるとすぐ次の URL を取りに行くので，常にウィンドウの数だけ
+      Lambda が実行中になる (バッチごとに一番遅いページを待たない)
+    - ウィンドウ (同時実行数) は controller がスロットリングに応じて増減する
+    - batch_size > 1 なら，1回の Lambda 呼び出しで batch_size ページ処理する
+    - 結果は届いた順 (ReorderBuffer なら urls の順) に1ページずつ書き込み，
+      書き込んだらチェックポイントに記録する
+    - 失敗したページはリトライキューに入れ，バックオフ後に再実行する
+      (待っている間もワーカーは他のページを処理する)
+    - 何度やってもだめなページは HTML を保存して諦める
+    - スロットリングはページの失敗に数えず，別のキューで
+      THROTTLE_ATTEMPTS 回までやり直す (諦めても HTML は保存しない)
+    - 呼び出しは executor (省略時は controller.maximum 個のスレッド) で実行する
+    - fun_name='listing' なら，products と urls の両方の結果を受け取る
+
+    returns:
+        リトライキュー (諦めたページは retries.failed に入っている)
+    """
+
+    page_index = {url: i for i, url in enumerate(urls)}
+
+    queue = asyncio.Queue()
+    for i in range(0, len(urls), batch_size):
+        queue.put_nowait(urls[i:i+batch_size])
+
+    if retries is None:
+        retries = RetryQueue()
+    throttled = RetryQueue(max_attempts=concurrency.THROTTLE_ATTEMPTS)
+
+    # URL -> 失敗した回数 / スロットリングされた回数
+    failures = {}
+    throttles = {}
+
+    loop = asyncio.get_running_loop()
+    total = len(urls)
+    done = 0
+
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=controller.maximum)
+
+    def next_batch():
+        """
+        次に処理する URL のリスト
+        リトライの時刻になったページを優先し，なければ新しいページを返す
+        """
+
+        batch = []
+        for waiting in (throttled, retries):
+            while len(batch) < batch_size:
+                item = waiting.pop_due()
+                if item is None:
+                    break
+                batch.append(item[0])
+
+        if batch:
+            return batch
+
+        try:
+            return queue.get_nowait()
+        except asyncio.QueueEmpty:
+            return None
+
+    with executor:
+        async def worker():
+            nonlocal done
+            while True:
+                # ウィンドウに空きができるまで待つ
+                if not controller.can_submit():
+                    await asyncio.sleep(POLL_INTERVAL)
+                    continue
+
+                batch = next_batch()
+                if batch is None:
+                    # 他のワーカーが実行中なら，リトライが増えるかもしれない
+                    waits = [w for w in (retries.next_due(),
+                                         throttled.next_due())
+                             if w is not None]
+                    wait = min(waits) if waits else None
+                    if wait is None and controller.in_flight == 0:
+                        return
+                    await asyncio.sleep(min(wait or POLL_INTERVAL,
+                                            POLL_INTERVAL))
+                    continue
+
+                urls = batch
+                token = controller.start()
+                try:
+                    # invoke は同期 API なのでスレッドで実行する
+                    if len(urls) == 1:
+                        result = await loop.run_in_executor(
+                            executor, get_products, urls[0], fun_name)
+                        results = {urls[0]: result}
+                    else:
+                        results = await loop.run_in_executor(
+                            executor, get_products_batch, urls, fun_name)
+                except BaseException:
+                    controller.finish(token, concurrency.ERROR)
+                    raise
+
+                controller.finish(token, batch_outcome(results), len(urls))
+
+                gave_up = []
+                for url in batch:
+                    rows, error = results[url]
+                    if error is not None and lambda_client.is_throttled(error):
+                        throttles[url] = throttles.get(url, 0) + 1
+                        if throttled.push(url, throttles[url], error):
+                            continue
+                        # ページの問題ではないので，HTML は保存しない
+                        retries.failed[url] = error
+                        writer.put(page_index[url], None)
+                        ckpt.failed(url, error)
+                    elif error is not None:
+                        print('RETRY', url, error)
+                        failures[url] = failures.get(url, 0) + 1
+                        if retries.push(url, failures[url], error):
+                            continue
+                        writer.put(page_index[url], None)
+                        ckpt.failed(url, error)
+                        gave_up.append(url)
+                    else:
+                        # listing ならチェックポイントには商品の行を記録する
+                        # (rows は dict なので，そのままでは行数にならない)
+                        page_rows = rows['products'] if fun_name == 'listing' \
+                            else rows
+                        writer.put(page_index[url], rows,
+                                   partial(ckpt.done, url, page_rows))
+
+                    done += 1
+                    if done % 100 == 0 or done == total:
+                        print('done', done, '/', total,
+                              'window', controller.limit)
+
+                for url in gave_up:
+                    try:
+                        await loop.run_in_executor(executor, save_html, url)
+                    except Exception as e:
+                        print('SAVE FAILED', url, e)
+
+        await asyncio.gather(*[worker()
+                               for _ in range(controller.maximum)])
+
+    return retries
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    checkpoint.add_arguments(parser)
+    lambda_client.add_arguments(parser)
+    parser.add_argument('--batch-size', type=int, default=10,
+                        help='1回の Lambda 呼び出しで処理するページ数')
+    concurrency.add_arguments(parser)
+    result_writer.add_arguments(parser)
+    parser.add_argument('--fused', action='store_true',
+                        help='商品一覧ページを1回だけ取得して，'
+                             'urls.py の結果 (urls.csv) も同時に作る')
+    options = parser.parse_args()
+
+    # --fused なら listing Lambda を呼び出し，進捗も別に記録する
+    fun_name = 'listing' if options.fused else 'products'
+    ckpt = Checkpoint(fun_name, options.checkpoint)
+    stats = lambda_client.new_stats()
+
     try:
         # 商品一覧ページの最大ページ数を抽出
         max_pages = max_products_page_num()
@@ -119,32 +335,56 @@ if __name__ == "__main__":
         # 全ての商品一覧ページを生成
         products_urls = generate_products_urls(max_pages)
 
-        """
-        感想一覧ページの [値段, URL, 最大ページ数] のリスト
+        # 完了済み (--resume) / 失敗以外 (--only-failed) を除外
+        products_urls = ckpt.pending(products_urls, options.mode)
+        print(str(len(products_urls)) + ' pages to crawl.')
 
-        - 本番は、products_urls に対してループを回す
-        - ここは並列化できる
         """
-        # 8個ずつ並行処理
-        bulk_size = 8
-        bulk_num = 1
-        bulk_end = math.ceil(max_pages / bulk_size)
-        print('bulk end', bulk_end, '\n')
-        for i in range(0, len(products_urls), bulk_size):
-            print("bulk", bulk_num)
-            urls = products_urls[i:i+bulk_size]
+        商品一覧ページごとに [商品名, 値段, 感想数, URL] のリスト
 
-            p = Pool(8)
-            result = p.map(get_products, urls)
-            result_flat = list(chain.from_iterable(result))
-
-            with open('products_reviews.csv', 'a', newline='') as f:
-                writer = csv.writer(f)
-                writer.writerows(result_flat)
+        - 同時に --concurrency 個の Lambda を実行し続ける
+          (スロットリングされない範囲で --max-concurrency まで自動的に増やす)
+        - 1回の呼び出しで --batch-size ページずつ処理する
+        """
+        controller = concurrency.from_arguments(options)
+        workers = controller.maximum
+
+        max_pool_connections = max(options.max_pool_connections, workers)
+        if options.invoker == lambda_client.LOCAL:
+            # ハンドラをこのマシンで実行するので，GIL を避けてプロセスで並列化
+            executor = ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=lambda_client.init_client,
+                initargs=(max_pool_connections, stats, options.invoker))
+        else:
+            # 全スレッドで1つのクライアントを共有する
+            lambda_client.init_client(max_pool_connections, stats)
+            executor = ThreadPoolExecutor(max_workers=workers)
+
+        if options.fused:
+            writer = result_writer.open_multi_writer(
+                {'products': result_writer.output_path('products_reviews',
+                                                       options.format),
+                 'urls': result_writer.output_path('urls', options.format)},
+                options.format, options.ordered)
+        else:
+            path = result_writer.output_path('products_reviews',
+                                             options.format)
+            writer = result_writer.open_writer(path, options.format,
+                                               options.ordered)
 
-                f.close()
+        with writer:
+            retries = asyncio.run(crawl(products_urls, controller, writer,
+                                        ckpt, options.batch_size, executor,
+                                        fun_name=fun_name))
 
-            bulk_num += 1
+        # 諦めたページを表示 (--only-failed でやり直せる)
+        retries.report()
+        controller.report()
 
     except RuntimeError as e:
         print('error', e)
+
+    finally:
+        ckpt.close()
+        lambda_client.report(stats)
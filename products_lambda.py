@@ -1,18 +1,147 @@
 import json
+import os
+import sqlite3
+import threading
 from urllib.parse import urljoin
 import re
-import requests
-from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor
+import http_cache
+import http_session
+import parsing
+from bs4 import BeautifulSoup, SoupStrainer
 
 
-DOMAIN = 'https://www.furusato-tax.jp'
+# ORIGIN_DOMAIN を指定すると，ローカルの代替サーバーなどに向けられる
+DOMAIN = os.environ.get('ORIGIN_DOMAIN', 'https://www.furusato-tax.jp')
 ROOT_URL = urljoin(DOMAIN, 'search?sort=11')
 
+# 商品ページを同時に取得する数
+TITLE_WORKERS = 8
 
-def get_soup(url: str) -> BeautifulSoup:
-    # url から BeautifulSoup を生成
-    html = requests.get(url).text
-    return BeautifulSoup(html, 'html.parser')
+# まとめて呼び出されたときに，同時に処理する商品一覧ページの数
+# (商品ページは 1ページあたり TITLE_WORKERS 並列で取得する)
+PAGE_WORKERS = 2
+
+# 商品名のキャッシュ (商品ページURL -> 商品名)
+# /tmp はウォームスタートの間残る．EFS などを指定すれば実行をまたいで残る
+TITLE_CACHE_PATH = os.environ.get('TITLE_CACHE_PATH',
+                                  '/tmp/product_titles.sqlite')
+
+# 1ページの商品数
+# (31番目以降は下部の「最近見たお礼の品」)
+CARDS_PER_PAGE = 30
+
+# 商品一覧ページは商品カードだけパースする
+CARD_STRAINER = SoupStrainer(
+    lambda name, attrs: name == 'div' and attrs.get('class') == 'card-product')
+
+# 商品ページは商品名の要素だけパースする
+TITLE_STRAINER = SoupStrainer(class_='ttl-h1__text')
+
+
+def get_soup(url: str, parse_only: SoupStrainer = None,
+             limit: int = None) -> BeautifulSoup:
+    # url から BeautifulSoup を生成 (受信しながらパースする)
+    html = http_session.iter_text(url)
+    return parsing.parse(html, parse_only, limit)
+
+
+class TitleCache:
+    """
+    商品ページURL -> 商品名 のキャッシュ
+
+    メモリ上の dict と SQLite ファイルの2段構え
+    モジュールレベルで持つので，ウォームスタートの間はメモリから返す
+    複数ページを並行して処理するので，SQLite はロックを取って使う
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.memory = {}
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute('CREATE TABLE IF NOT EXISTS titles'
+                              ' (url TEXT PRIMARY KEY, title TEXT NOT NULL)')
+        return self.conn
+
+    def get_many(self, urls: list[str]) -> dict:
+        missing = [url for url in urls if url not in self.memory]
+        if missing:
+            with self.lock:
+                conn = self._connect()
+                for url in missing:
+                    row = conn.execute(
+                        'SELECT title FROM titles WHERE url = ?',
+                        (url,)).fetchone()
+                    if row:
+                        self.memory[url] = row[0]
+
+        return {url: self.memory[url] for url in urls if url in self.memory}
+
+    def put_many(self, titles: dict):
+        if not titles:
+            return
+
+        self.memory.update(titles)
+        with self.lock:
+            conn = self._connect()
+            conn.executemany('INSERT OR REPLACE INTO titles VALUES (?, ?)',
+                             titles.items())
+            conn.commit()
+
+
+TITLE_CACHE = TitleCache(TITLE_CACHE_PATH)
+
+
+def get_title(url: str) -> str:
+    # 商品ページから商品名を取得
+    # (商品名の要素が閉じたら残りはパースしない)
+    soup = get_soup(url, TITLE_STRAINER, 1)
+    return parse_title(soup)
+
+
+def parse_title(soup: BeautifulSoup) -> str:
+    # 商品ページの soup から商品名を取り出す
+    title = 'no title'
+    title_elem = soup.select_one('.ttl-h1__text')
+    if title_elem:
+        title = title_elem.string
+        if title is None:
+            strings = list(title_elem.stripped_strings)
+            if len(strings) == 0:
+                title = 'no title'
+            else:
+                # 「チョイス限定」に対応
+                title = strings[-1]
+        if title is None:
+            title = 'no title'
+
+    return str(title)
+
+
+def get_titles(urls: list[str]) -> dict:
+    """
+    商品ページURLのリストから 商品ページURL -> 商品名 を返す
+    キャッシュにないものだけ並行して取得する
+    """
+
+    titles = TITLE_CACHE.get_many(urls)
+
+    missing = list(dict.fromkeys(url for url in urls if url not in titles))
+    if missing:
+        with ThreadPoolExecutor(max_workers=TITLE_WORKERS) as executor:
+            fetched = dict(zip(missing, executor.map(get_title, missing)))
+
+        # 取れなかったものは次回また取りに行く
+        TITLE_CACHE.put_many({url: title for url, title in fetched.items()
+                              if title != 'no title'})
+        titles.update(fetched)
+
+    return titles
 
 
 def find_reviews_urls(products_url: str) -> list[str]:
@@ -29,73 +158,126 @@ def find_reviews_urls(products_url: str) -> list[str]:
 
     """
 
-    # 商品一覧ページのHTMLを取得
-    soup = get_soup(products_url)
+    def parse(res) -> list:
+        # 商品一覧ページのHTMLを取得 (商品カードだけ，30個読んだら打ち切る)
+        html = http_session.iter_response_text(res)
+        soup = parsing.parse(html, CARD_STRAINER, CARDS_PER_PAGE)
 
-    # 商品カードページ (31番目以降は下部の「最近見たお礼の品」なので除外)
-    product_cards = soup.select('div[class="card-product"]')[:30]
+        # 商品カードページ (31番目以降は下部の「最近見たお礼の品」なので除外)
+        product_cards = soup.select(
+            'div[class="card-product"]')[:CARDS_PER_PAGE]
 
-    # list of [商品名, 感想数]
-    result = []
-    for card in product_cards:
+        return parse_cards(products_url, product_cards)
 
-        # 商品名の取得
+    # 商品一覧ページが変わっていなければ (304)，前回パースした結果を使う
+    return http_session.get_parsed(products_url, 'products', parse)
+
+
+def parse_cards(products_url: str, product_cards: list) -> list:
+    """
+    商品一覧ページの商品カードから [商品名, 値段, 感想数, URL] のリストを作る
+    商品名は商品ページから取得する (キャッシュにあればそれを使う)
+    """
+
+    # 商品ページのURL
+    hrefs = []
+    for card in product_cards:
         product_link_elem = card.select_one('.card-product__link')
 
         href = ''
         if product_link_elem:
             href = product_link_elem.get('href')
 
+        hrefs.append(href)
+
+    # 商品名をまとめて取得 (キャッシュにないものだけ並行して取得)
+    links = [urljoin(DOMAIN, href) for href in hrefs if href]
+    titles = get_titles(links)
+
+    # list of [商品名, 値段, 感想数, URL]
+    result = []
+    for card, href in zip(product_cards, hrefs):
+
+        # 商品名の取得
         title = 'no title'
         if href is None or len(href) == 0:
             href = products_url
         else:
-            link = urljoin(DOMAIN, href)
-            product_page_html = get_soup(link)
-            title_elem = product_page_html.select_one('.ttl-h1__text')
-            if title_elem:
-                title = title_elem.string
-                if title is None:
-                    strings = list(title_elem.stripped_strings)
-                    if len(strings) == 0:
-                        title = 'no title'
-                    else:
-                        # 「チョイス限定」に対応
-                        title = strings[-1]
-                if title is None:
-                    title = 'no title'
-
-        title = title.replace('\n', '') \
-                     .replace('<br/>', '')
-
-        # 値段の取得
-        price = 0
-        price_elem = card.select_one('.card-product__price')
-        if price_elem:
-            price_str = price_elem.string.replace(u'\xa0', ' ').split()[0]
-            price = int(price_str.replace(',', ''))
-
-        # '感想(211)'
-        url_elem = card.select_one('.card-product__comment')
-        if url_elem is None:
-            # [商品名, 値段, 感想数, URL]
-            result.append([title, price, 0, href])
-            continue
-
-        kansou_children = list(url_elem.children)
-        kansou_str = kansou_children[2]
-
-        # カッコの中を正規表現で抽出
-        kansou_num_str = re.search(r'(?<=\().*(?=\))', kansou_str).group()
-        kansou_num = int(kansou_num_str)
+            title = titles[urljoin(DOMAIN, href)]
 
         # [商品名, 値段, 感想数, URL]
-        result.append([title, price, kansou_num, href])
+        result.append(parse_card(card, title, href))
 
     return result
 
 
+def parse_card(card, title: str, href: str) -> list:
+    # 商品カードから [商品名, 値段, 感想数, URL] を取り出す
+    title = title.replace('\n', '') \
+                 .replace('<br/>', '')
+
+    # 値段の取得
+    price = 0
+    price_elem = card.select_one('.card-product__price')
+    if price_elem:
+        price_str = price_elem.string.replace(u'\xa0', ' ').split()[0]
+        price = int(price_str.replace(',', ''))
+
+    # '感想(211)'
+    url_elem = card.select_one('.card-product__comment')
+    if url_elem is None:
+        # [商品名, 値段, 感想数, URL]
+        return [title, price, 0, href]
+
+    kansou_children = list(url_elem.children)
+    kansou_str = kansou_children[2]
+
+    # カッコの中を正規表現で抽出
+    kansou_num_str = re.search(r'(?<=\().*(?=\))', kansou_str).group()
+    kansou_num = int(kansou_num_str)
+
+    # [商品名, 値段, 感想数, URL]
+    return [title, price, kansou_num, href]
+
+
+def find_products(url: str) -> dict:
+    # 1ページ分の結果 (失敗した場合はエラー) を返す
+    try:
+        return {'url': url, 'body': find_reviews_urls(url)}
+    except Exception as e:
+        print(url, e)
+        return {'url': url, 'error': str(e)}
+
+
 def lambda_handler(event, context):
+    """
+    商品一覧ページから，全ての商品と感想数を取得する
+
+    event:
+        url  : 商品一覧ページのURL
+        urls : 商品一覧ページのURLのリスト (まとめて処理する場合)
+
+    returns:
+        url の場合  : body に [[商品名, 値段, 感想数, URL], ...] の JSON
+                      失敗した場合は error
+        urls の場合 : results に URL ごとの {url, body} または {url, error}
+        http_retries : HTTP のリトライ回数と待ち時間 (秒)
+        http_cache   : HTTP キャッシュのヒット数など
+    """
+
+    http_session.RETRY_STATS.reset()
+    http_cache.CACHE_STATS.reset()
+
+    if 'urls' in event:
+        # 複数ページを並行して処理し，URL ごとに結果を返す
+        # (失敗したページだけ呼び出し側でリトライできる)
+        with ThreadPoolExecutor(max_workers=PAGE_WORKERS) as executor:
+            results = list(executor.map(find_products, event['urls']))
+
+        return {'statusCode': 200, 'results': results,
+                'http_retries': http_session.RETRY_STATS.to_dict(),
+                'http_cache': http_cache.CACHE_STATS.to_dict()}
+
     url = event["url"]
     response = {'statusCode': 200}
 
@@ -107,5 +289,7 @@ def lambda_handler(event, context):
         response['error'] = json.dumps(str(e))
     finally:
         response['url'] = url
+        response['http_retries'] = http_session.RETRY_STATS.to_dict()
+        response['http_cache'] = http_cache.CACHE_STATS.to_dict()
 
     return response
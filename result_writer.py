@@ -0,0 +1,172 @@
+import csv
+import json
+from typing import Callable, Iterable, Iterator, Optional
+
+# 出力形式
+CSV = 'csv'
+NDJSON = 'ndjson'   # 1行に1つの JSON の配列
+FORMATS = (CSV, NDJSON)
+
+
+def output_path(name: str, fmt: str = CSV) -> str:
+    # urls -> urls.csv / urls.ndjson
+    return name + '.' + fmt
+
+
+def read_rows(path: str) -> Iterator[list]:
+    # CSV / NDJSON (拡張子で判定) の行を1行ずつ返す
+    with open(path, 'r', newline='') as f:
+        if path.endswith('.' + NDJSON):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from csv.reader(f, delimiter=',')
+
+
+class RowWriter:
+    """
+    結果の行をファイルに追記する
+
+    届いた順にすぐ書き込んで flush するので，親プロセスは結果を溜めない
+    (途中で止まっても，書いた分は残る)
+    """
+
+    def __init__(self, path: str, fmt: str = CSV):
+        self.fmt = fmt
+        if fmt == NDJSON:
+            self.file = open(path, 'a', encoding='utf-8')
+        else:
+            self.file = open(path, 'a', newline='')
+            self.writer = csv.writer(self.file)
+        self.rows = 0
+
+    def write(self, rows: Iterable[list]):
+        count = 0
+        if self.fmt == NDJSON:
+            for row in rows:
+                self.file.write(json.dumps(row, ensure_ascii=False) + '\n')
+                count += 1
+        else:
+            for row in rows:
+                self.writer.writerow(row)
+                count += 1
+        self.file.flush()
+        self.rows += count
+
+    def put(self, seq: int, rows: Optional[list],
+            done: Optional[Callable[[], None]] = None):
+        """
+        seq 番目の結果を書き込む (順番は無視する)
+        rows が None なら何も書かない (失敗した場合)
+        done は書き込んだあとに呼ぶ (チェックポイントの記録など)
+        """
+
+        if rows is not None:
+            self.write(rows)
+        if done is not None:
+            done()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class MultiWriter:
+    """
+    1つの結果を，種類ごとに別のファイルに書き込む
+
+        writers : {'products': RowWriter, 'urls': RowWriter}
+        rows    : {'products': [...], 'urls': [...]}
+    """
+
+    def __init__(self, writers: dict):
+        self.writers = writers
+
+    def put(self, seq: int, rows: Optional[dict],
+            done: Optional[Callable[[], None]] = None):
+        # RowWriter.put と同じ (全ての種類を書き込んでから done を呼ぶ)
+        if rows is not None:
+            for key, writer in self.writers.items():
+                writer.write(rows.get(key, []))
+        if done is not None:
+            done()
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ReorderBuffer:
+    """
+    結果を seq の順に書き込む
+
+    seq 番目の結果が届くまで，それより後の結果はメモリに溜めておく
+    出力の順番は毎回同じになるが，遅い結果が1つあると溜まる量が増える
+    (溜まった数の最大は peak に入る)
+    """
+
+    def __init__(self, writer, start: int = 0):
+        self.writer = writer
+        self.next = start
+        self.pending = {}
+        self.peak = 0
+
+    def put(self, seq: int, rows: Optional[list],
+            done: Optional[Callable[[], None]] = None):
+        # RowWriter.put と同じ (done は実際に書き込んだときに呼ぶ)
+        self.pending[seq] = (rows, done)
+        self.peak = max(self.peak, len(self.pending))
+
+        while self.next in self.pending:
+            self.writer.put(self.next, *self.pending.pop(self.next))
+            self.next += 1
+
+    def close(self):
+        # 届かなかった番号は飛ばして，残りを順に書き込む
+        for seq in sorted(self.pending):
+            self.writer.put(seq, *self.pending[seq])
+        self.pending = {}
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_writer(path: str, fmt: str = CSV, ordered: bool = False):
+    # ordered なら seq の順，そうでなければ届いた順に書き込む
+    writer = RowWriter(path, fmt)
+    if ordered:
+        return ReorderBuffer(writer)
+    return writer
+
+
+def open_multi_writer(paths: dict, fmt: str = CSV, ordered: bool = False):
+    # 種類 -> パス の dict から MultiWriter を作る (ordered は open_writer と同じ)
+    writer = MultiWriter({key: RowWriter(path, fmt)
+                          for key, path in paths.items()})
+    if ordered:
+        return ReorderBuffer(writer)
+    return writer
+
+
+def add_arguments(parser):
+    # ドライバ共通のコマンドライン引数
+    parser.add_argument('--format', choices=FORMATS, default=CSV,
+                        help='出力形式 (ndjson は1行に1つの JSON の配列)')
+    parser.add_argument('--ordered', action='store_true',
+                        help='届いた順ではなく，入力の順に書き込む')
@@ -0,0 +1,94 @@
+import heapq
+import itertools
+import random
+import time
+from typing import Hashable, Optional, Tuple
+
+# 1回目のリトライまでの最大待ち時間 (秒)
+BASE_DELAY = 2.0
+
+# 待ち時間の上限 (秒)
+MAX_DELAY = 60.0
+
+# これだけ失敗したら諦める
+MAX_ATTEMPTS = 5
+
+
+def backoff(attempt: int, base: float = BASE_DELAY,
+            cap: float = MAX_DELAY) -> float:
+    """
+    attempt 回目の失敗のあとの待ち時間 (秒)
+    指数バックオフの上限までの一様乱数にする (full jitter)
+
+        attempt=1: 0〜2秒, attempt=2: 0〜4秒, attempt=3: 0〜8秒, ...
+
+    同時に失敗したページのリトライが同じ時刻に集中しない
+    """
+
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+class RetryQueue:
+    """
+    失敗した項目を，次に実行してよい時刻の順に並べておくキュー
+
+    失敗した項目を push して，時刻になったものを pop_due で取り出す
+    待っている間は他の項目を処理できるので，ワーカーが sleep で止まらない
+    max_attempts 回失敗した項目は諦めて failed に入れる
+    """
+
+    def __init__(self, max_attempts: int = MAX_ATTEMPTS,
+                 base: float = BASE_DELAY, cap: float = MAX_DELAY):
+        self.max_attempts = max_attempts
+        self.base = base
+        self.cap = cap
+
+        # (実行してよい時刻, 順番, 項目, 失敗回数)
+        self.heap = []
+        self.counter = itertools.count()
+
+        # 諦めた項目 -> 最後のエラー
+        self.failed = {}
+
+        # リトライした回数と，待ち時間の合計
+        self.retries = 0
+        self.delay = 0.0
+
+    def __len__(self) -> int:
+        return len(self.heap)
+
+    def push(self, item: Hashable, attempt: int, error: str) -> bool:
+        """
+        attempt 回目の失敗を記録する
+        リトライする場合は True，諦めた場合は False を返す
+        """
+
+        if attempt >= self.max_attempts:
+            self.failed[item] = error
+            return False
+
+        delay = backoff(attempt, self.base, self.cap)
+        heapq.heappush(self.heap, (time.monotonic() + delay,
+                                   next(self.counter), item, attempt))
+        self.retries += 1
+        self.delay += delay
+        return True
+
+    def pop_due(self) -> Optional[Tuple[Hashable, int]]:
+        # 時刻になった項目を (項目, 失敗回数) で返す (なければ None)
+        if self.heap and self.heap[0][0] <= time.monotonic():
+            _, _, item, attempt = heapq.heappop(self.heap)
+            return item, attempt
+        return None
+
+    def next_due(self) -> Optional[float]:
+        # 次の項目の時刻までの秒数 (なければ None)
+        if not self.heap:
+            return None
+        return max(0.0, self.heap[0][0] - time.monotonic())
+
+    def report(self):
+        print('retries: %d (total backoff %.1f s), gave up: %d'
+              % (self.retries, self.delay, len(self.failed)))
+        for item, error in self.failed.items():
+            print('FAILED', item, error)
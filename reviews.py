@@ -1,81 +1,357 @@
 from urllib.parse import urljoin
-import boto3
 import json
-import csv
-from multiprocessing import Pool
-from itertools import chain
+import os
+import lambda_client
+from functools import partial
+import math
+import time
+import scheduler
+import concurrency
+import result_writer
+import argparse
+import checkpoint
+from checkpoint import Checkpoint
+import high_water
+import payload
+import snapshot
+from snapshot import Snapshot
 
-DOMAIN = 'https://www.furusato-tax.jp'
+# ORIGIN_DOMAIN を指定すると，ローカルの代替サーバーなどに向けられる
+DOMAIN = os.environ.get('ORIGIN_DOMAIN', 'https://www.furusato-tax.jp')
 ROOT_URL = urljoin(DOMAIN, 'search?sort=11')
 
+# Lambda が大きな結果を置く場所 (PAYLOAD_BLOB_DIR，Lambda と同じ場所)
+BLOB_STORE = payload.default_store()
 
-# 全ての感想を取得（lambdaを呼び出す関数）
-def get_reviews(price: int, url: str, maxpages: int):
-    client = boto3.client('lambda')
-    payload = {
+# 1回の Lambda 呼び出しで取得する感想ページ数の目安
+# これより多い商品はページ範囲で分割する
+SHARD_PAGES = 10
+
+
+# 感想を取得（lambdaを呼び出す関数）
+# start_page, end_page を指定すると，その範囲のページだけ取得する
+# since (前回の high-water mark) を渡すと，それより新しい感想だけを返す
+# Lambda が制限時間の前に打ち切った場合は，続きのページ (next_page) も返す
+# (続きは別のジョブにするので，続きが失敗しても取得済みの分は失わない)
+def get_reviews(price: int, url: str, maxpages: int,
+                start_page: int = 1, end_page: int = None,
+                since: dict = None):
+    event = {
         "price": price,
         "url": url,
-        "maxpages": maxpages
+        "maxpages": maxpages,
+        "start_page": start_page,
+        "end_page": end_page or maxpages,
     }
-    response = client.invoke(
-        FunctionName='reviews',
-        InvocationType='RequestResponse',
-        Payload=json.dumps(payload).encode('utf-8'),
-    )
-    decoded = response['Payload'].read().decode('utf-8')
+    if since is not None:
+        event["since"] = since
+    decoded = lambda_client.invoke('reviews', event)
     data = json.loads(decoded)
-    body = json.loads(data['body'])
+    reviews = payload.decode(data['body'], BLOB_STORE)
+
+    return reviews, data.get('next_page')
+
+
+# 失敗しても止まらないように，(URL, 結果, 次のページ, エラー) を返す
+def try_get_reviews(price: int, url: str, maxpages: int,
+                    start_page: int = 1, end_page: int = None,
+                    since: dict = None):
+    try:
+        body, next_page = get_reviews(price, url, maxpages, start_page,
+                                      end_page, since)
+        return url, body, next_page, None
+    except Exception as e:
+        print('FAILED', url, start_page, end_page, e)
+        return url, None, None, str(e)
+
+
+def split_pages(maxpages: int, shard_pages: int = SHARD_PAGES):
+    """
+    1..maxpages を，ページ数がなるべく均等な範囲に分ける
+
+        split_pages(23, 10) -> [(1, 8), (9, 16), (17, 23)]
+    """
+
+    if maxpages <= shard_pages:
+        return [(1, maxpages)]
+
+    shards = math.ceil(maxpages / shard_pages)
+    base, extra = divmod(maxpages, shards)
+
+    ranges = []
+    start = 1
+    for i in range(shards):
+        size = base + (1 if i < extra else 0)
+        ranges.append((start, start + size - 1))
+        start += size
+
+    return ranges
+
+
+def job_cost(job) -> int:
+    # ジョブの重さ = 取得する感想ページ数 (0 ページでも呼び出しは1回)
+    _, _, _, _, start, end, _ = job
+    return max(1, end - start + 1)
+
+
+def run_job(job):
+    """
+    1ジョブ (1商品のあるページ範囲) を処理する
+
+        job : (商品の番号, 価格, URL, 最大ページ数, 開始ページ, 終了ページ,
+               high-water mark の (日付, fingerprint) (なければ None))
+
+    returns:
+        (ジョブ, 結果, 次のページ, エラー, 所要時間)
+        次のページは，Lambda が制限時間の前に打ち切った場合だけ
+    """
+
+    _, price, url, maxpages, start, end, mark = job
+    # ジョブは dict のキーにするので，mark は tuple で持っている
+    since = None
+    if mark is not None:
+        since = {'date': mark[0], 'fingerprint': mark[1]}
+
+    begin = time.perf_counter()
+    _, body, next_page, error = try_get_reviews(price, url, maxpages,
+                                                start, end, since)
+    return job, body, next_page, error, time.perf_counter() - begin
+
+
+def next_job(job, result):
+    # Lambda が打ち切った場合，続きのページから取得するジョブ
+    index, price, url, maxpages, _, end, mark = job
+    _, _, next_page, _, _ = result
+    if next_page is None:
+        return None
+    return (index, price, url, maxpages, next_page, end, mark)
+
+
+def job_outcome(result) -> str:
+    # run_job の結果が成功 / 失敗 / スロットリングのどれか
+    _, _, _, error, _ = result
+    if error is None:
+        return concurrency.OK
+    if lambda_client.is_throttled(error):
+        return concurrency.THROTTLED
+    return concurrency.ERROR
+
+
+def record_done(ckpt: Checkpoint, snap: Snapshot, url: str, reviews: list,
+                count):
+    # 保存した商品をチェックポイントに記録し，
+    # 次の --delta のために今回の感想数と最新の感想を記録する
+    ckpt.done(url, reviews)
+    if count is not None:
+        snap.put(url, count)
+    if reviews:
+        snap.put_mark(url, high_water.mark(reviews))
+
+
+def changed_products(data: list, snap: Snapshot):
+    """
+    前回から感想が増えた商品と，増えた感想の数を返す
 
-    return body
+        data : [[価格, URL, 最大ページ数, 感想数], ...]
+
+    returns:
+        (感想が増えた商品 (または前回の記録がない商品) の data,
+         URL -> 先頭から取得する感想数 (全て取得する商品は含まない),
+         URL -> 前回の high-water mark)
+
+    high-water mark がある商品は，Lambda が前回の感想に当たった所で
+    止まるので，感想数による制限はしない (感想が削除されていても正確)
+    感想数が減っていても，削除と新しい感想が同時にあったかもしれないので
+    取得する (前回の感想に当たればすぐ止まる)
+    """
+
+    urls = [row[1] for row in data]
+    previous = snap.get_many(urls)
+    marks = snap.get_marks(urls)
+
+    changed = []
+    limits = {}
+    since = {}
+    for row in data:
+        url, count = row[1], row[3]
+        limit = snapshot.new_reviews(count, previous.get(url))
+        if url in marks:
+            if count is not None and count == previous.get(url):
+                continue
+            since[url] = marks[url]
+            changed.append(row)
+            continue
+
+        if limit == 0:
+            # 感想が減った場合は，記録だけ今の数に合わせる
+            if count < previous[url]:
+                snap.put(url, count)
+            continue
+
+        if limit is not None:
+            limits[url] = limit
+        changed.append(row)
+
+    return changed, limits, since
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    checkpoint.add_arguments(parser)
+    lambda_client.add_arguments(parser)
+    parser.add_argument('--shard-pages', type=int, default=SHARD_PAGES,
+                        help='1回の Lambda 呼び出しで取得する感想ページ数')
+    concurrency.add_arguments(parser)
+    result_writer.add_arguments(parser)
+    parser.add_argument('--input', default='urls.csv',
+                        help='urls.py の出力 (.csv / .ndjson)')
+    snapshot.add_arguments(parser)
+    options = parser.parse_args()
+
+    ckpt = Checkpoint('reviews', options.checkpoint)
+    snap = Snapshot(options.snapshot)
+    stats = lambda_client.new_stats()
+
     try:
-        # CSVから商品価格, URL, 感想ページ数を順に読み込む (row)
+        # CSVから商品価格, URL, 感想ページ数, 感想数を順に読み込む (row)
+        # (感想数のない古い urls.csv なら None)
         data = []
-        with open('urls.csv', 'r') as f:
-            reader = csv.reader(f, delimiter=',')
-            for row in reader:
-                data_row = [int(row[0]), row[1], int(row[2])]
-                data.append(data_row)
-
-        # 全ての row に対して、全ての感想ページに対して
-        # すべての感想データを抽出する
-        # lambdaの中で感想ページをなめる
-        # 8ずつ並行処理
-        bulk_size = 8
-        bulk_num = 1
-        for i in range(0, len(data), bulk_size):
-            print("bulk", bulk_num)
-            rows = data[i:i+bulk_size]
-
-            p = Pool(8)
-
-            """
-            lambdaでその商品の感想を全て抽出する
-
-            - title   : 感想タイトル
-            - gender  : 性別
-            - age     : 年齢
-            - date    : 日付
-            - product : 商品名
-            - price   : 価格
-            - label   : ラベル
-            - text    : 本文
-            - reason  : 商品を選んだ理由
-            """
-            args = [(int(row[0]), row[1], int(row[2])) for row in rows]
-            result = p.starmap(get_reviews, args)
-            result_flat = list(chain.from_iterable(result))
-
-            # CSVに保存する
-            with open('reviews.csv', 'a', newline='') as f:
-                writer = csv.writer(f)
-                writer.writerows(result_flat)
-
-                f.close()
-
-            bulk_num += 1
+        for row in result_writer.read_rows(options.input):
+            count = int(row[3]) if len(row) > 3 else None
+            data_row = [int(row[0]), row[1], int(row[2]), count]
+            data.append(data_row)
+
+        # 完了済み (--resume) / 失敗以外 (--only-failed) を除外
+        pending = set(ckpt.pending([row[1] for row in data], options.mode))
+        data = [row for row in data if row[1] in pending]
+
+        # --delta なら，前回から増えた感想を含むページだけ取得する
+        # (感想は新しい順なので，増えた n 件は先頭の n 件)
+        limits = {}
+        since = {}
+        if options.delta:
+            total = len(data)
+            data, limits, since = changed_products(data, snap)
+            print(len(data), '/', total, 'products changed')
+
+        """
+        lambdaでその商品の感想を全て抽出する
+
+        - title   : 感想タイトル
+        - gender  : 性別
+        - age     : 年齢
+        - date    : 日付
+        - product : 商品名
+        - price   : 価格
+        - label   : ラベル
+        - text    : 本文
+        - reason  : 商品を選んだ理由
+
+        ページ数の多い商品はページ範囲で分割して呼び出す
+        """
+        jobs = []
+        for index, row in enumerate(data):
+            price, url, maxpages = int(row[0]), row[1], int(row[2])
+            if url in since:
+                # 途中で止まるので分割しない
+                mark = (since[url]['date'], since[url]['fingerprint'])
+                jobs.append((index, price, url, maxpages, 1, maxpages, mark))
+                continue
+
+            pages = maxpages
+            if url in limits:
+                pages = min(maxpages, snapshot.pages_for(limits[url]))
+            for start, end in split_pages(pages, options.shard_pages):
+                jobs.append((index, price, url, maxpages, start, end, None))
+
+        # 感想ページ数の多いジョブから順に，空いたワーカーに渡していく
+        # (8個ずつ区切って一番遅いジョブを待つことはしない)
+        # 同時実行数はスロットリングされない範囲で自動的に増減する
+        jobs = scheduler.lpt_order(jobs, job_cost)
+        controller = concurrency.from_arguments(options)
+        makespan = scheduler.Makespan([job_cost(job) for job in jobs])
+        print(len(data), 'products,', len(jobs), 'jobs')
+
+        # 商品ごとに，残りのジョブ数と取得済みの範囲
+        remaining = [0] * len(data)
+        for job in jobs:
+            remaining[job[0]] += 1
+        parts = [{} for _ in data]
+        errors = [None] * len(data)
+
+        started = time.perf_counter()
+        done = 0
+        total = len(jobs)
+
+        # 同時に実行中になるのはジョブの数まで
+        workers = max(1, min(controller.maximum, len(jobs)))
+        with lambda_client.new_pool(workers, options.max_pool_connections,
+                                    stats, options.invoker) as p, \
+                result_writer.open_writer(
+                    result_writer.output_path('reviews', options.format),
+                    options.format, options.ordered) as writer:
+
+            # Lambda が打ち切ったジョブは，続きのページから新しいジョブにする
+            results = concurrency.imap_adaptive(p, run_job, jobs, controller,
+                                                job_outcome, job_cost,
+                                                follow=next_job)
+            for _, (job, body, next_page, error, seconds) in results:
+                index, _, url, _, start, _, _ = job
+                if next_page is None:
+                    makespan.record(job_cost(job), seconds)
+                else:
+                    # 打ち切った場合は，取得できたページ数だけ記録する
+                    makespan.record(next_page - start, seconds)
+
+                if error is not None:
+                    errors[index] = errors[index] or error
+                else:
+                    parts[index][start] = body
+                if next_page is not None:
+                    # 続きのジョブが終わるまで，その商品は保存しない
+                    remaining[index] += 1
+                    total += 1
+
+                done += 1
+                if done % 100 == 0 or done == total:
+                    print('done', done, '/', total,
+                          'window', controller.limit)
+
+                remaining[index] -= 1
+                if remaining[index] > 0:
+                    continue
+
+                # 商品の全ての範囲が終わったら，ページ順に結合して保存する
+                # 1つでも失敗した範囲があれば，その商品は失敗とする
+                # (--ordered なら urls.csv の順に書き込む)
+                if errors[index] is not None:
+                    writer.put(index, None)
+                    ckpt.failed(url, errors[index])
+                else:
+                    reviews = []
+                    for key in sorted(parts[index]):
+                        reviews += parts[index][key]
+
+                    # --delta なら増えた感想だけ残す
+                    if url in limits:
+                        reviews = reviews[:limits[url]]
+
+                    writer.put(index, reviews,
+                               partial(record_done, ckpt, snap, url, reviews,
+                                       data[index][3]))
+
+                parts[index] = None
+
+        # ウィンドウは AIMD で増減するので，実際の平均のウィンドウで見積もる
+        window = controller.average_window()
+        makespan.report(time.perf_counter() - started, round(window),
+                        'workers (average window %.1f)' % window)
+        controller.report()
 
     except RuntimeError as e:
         print(e)
+
+    finally:
+        ckpt.close()
+        snap.close()
+        lambda_client.report(stats)
@@ -1,61 +1,158 @@
-import json
+import time
+from typing import Callable, Optional
 from urllib.parse import urljoin
-import requests
-from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import http_cache
+import http_session
+import high_water
+import parsing
+import payload
+from bs4 import SoupStrainer
 
+# 1回の呼び出しで同時に取得する感想ページ数の上限
+# (相手サーバーに負荷をかけすぎないように)
+CONCURRENCY = 4
 
-def fetch_html(url: str) -> BeautifulSoup:
-    html = requests.get(url).text
-    return BeautifulSoup(html, 'html.parser')
+# 1ページの感想数
+REVIEWS_PER_PAGE = 10
+
+# 結果をまとめて返すのに使う時間 (ミリ秒)
+RESULT_MS = 5000
+
+# Lambda の制限時間の前に残しておく時間 (ミリ秒)
+# 取得を始めたページは，止まってもリトライを含めて
+# http_session.max_request_seconds() でタイムアウトするので，その分も残す
+# (新しいページを始めなければ，取得中のページを待っても間に合う)
+RESERVE_MS = RESULT_MS + int(http_session.max_request_seconds() * 1000)
+
+# 感想カードだけパースする
+REVIEW_STRAINER = SoupStrainer(class_='review-list__content')
+
+# レスポンスに入らない大きさの感想を置く場所 (PAYLOAD_BLOB_DIR)
+BLOB_STORE = payload.default_store()
+
+
+def parse_review(card, price: int) -> list:
+    # 感想カードから1件分の感想を取り出す
+    title_elem = card.select_one('.review-list__title')
+    title = title_elem.string
+
+    personal = card.select_one('.review-list__data').string
+    lm1 = personal.find('｜') + 1
+    lm2 = personal.rfind('｜') + 1
+    gender = personal[lm1:lm2 - 1]
+    age = personal[lm2:]
+
+    date = card.select_one('.review-list__date').string[4:]
+
+    product = card.select_one('.review-list__name').string[3:]
+
+    labels = [elem.string for elem in card.select('.review-tag__text')]
+    label = '/'.join(labels)
+
+    text_elem = card.select_one('.review-list__text')
+    text = text_elem.decode_contents(formatter="html")
+    # 改行の削除
+    text = text.replace('\n', '') \
+               .replace('　', ' ') \
+               .replace('<br/>', '')
+
+    reasons = [elem.string for elem in card.select('.review-reason__item')]
+    reason = '/'.join(reasons)
+
+    review = [title, gender, age, date,
+              product, price, label, text, reason]
+    return review
 
 
 def get_reviews_per_page(price: int, base_url: str, page: int):
-    reviews = []
     url = urljoin(base_url, "?page="+str(page))
-    soup = fetch_html(url)
-    review_cards = soup.select('.review-list__content')
-    for card in review_cards:
-        title_elem = card.select_one('.review-list__title')
-        title = title_elem.string
 
-        personal = card.select_one('.review-list__data').string
-        lm1 = personal.find('｜') + 1
-        lm2 = personal.rfind('｜') + 1
-        gender = personal[lm1:lm2 - 1]
-        age = personal[lm2:]
+    def parse(res) -> list:
+        # 感想カードだけ，10個読んだら打ち切る
+        html = http_session.iter_response_text(res)
+        soup = parsing.parse(html, REVIEW_STRAINER, REVIEWS_PER_PAGE)
+        review_cards = soup.select('.review-list__content')
+        return [parse_review(card, price) for card in review_cards]
+
+    # ページが変わっていなければ (304)，前回パースした結果を使う
+    # (価格は商品一覧ページから渡される値なので，名前に含める)
+    return http_session.get_parsed(url, 'reviews:%d' % price, parse)
 
-        date = card.select_one('.review-list__date').string[4:]
 
-        product = card.select_one('.review-list__name').string[3:]
+def get_all_reviews(price: int, url: str,  maxpages: int,
+                    concurrency: int = CONCURRENCY, start_page: int = 1,
+                    remaining: Optional[Callable[[], int]] = None,
+                    since: Optional[dict] = None):
+    """
+    start_page から maxpages ページ目までを取得する
+    感想ページを concurrency 個ずつ並行して取得し，ページ順に並べて返す
+
+    remaining (残り時間をミリ秒で返す関数) を渡すと，制限時間までに
+    終わらないページは取得を始めない
+    (少なくとも1ページは取得するので，続きから呼び出し直せば必ず進む)
 
-        labels = [elem.string for elem in card.select('.review-tag__text')]
-        label = '/'.join(labels)
+    since (前回の high-water mark) を渡すと，前回取得済みの感想が
+    見つかったページより後は取得せず，それより新しい感想だけを返す
+
+    returns:
+        (感想のリスト, 次に取得するページ (最後まで取得したら None))
+    """
 
-        text_elem = card.select_one('.review-list__text')
-        text = text_elem.decode_contents(formatter="html")
-        # 改行の削除
-        text = text.replace('\n', '') \
-                   .replace('　', ' ') \
-                   .replace('<br/>', '')
+    pages = {}
+    next_page = start_page
 
-        reasons = [elem.string for elem in card.select('.review-reason__item')]
-        reason = '/'.join(reasons)
+    # 前回取得済みの感想が見つかった最初のページ
+    seen_page = None
 
-        review = [title, gender, age, date,
-                  product, price, label, text, reason]
-        reviews.append(review)
+    # 1ページの取得にかかった最長時間 (ミリ秒)
+    page_ms = 0
 
-    return reviews
+    def fetch(page: int):
+        begin = time.monotonic()
+        reviews = get_reviews_per_page(price, url, page)
+        return page, reviews, (time.monotonic() - begin) * 1000
 
+    def has_time() -> bool:
+        if remaining is None or next_page == start_page:
+            return True
+        return remaining() > RESERVE_MS + page_ms
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        running = set()
+        while True:
+            while (next_page <= maxpages and len(running) < concurrency
+                   and seen_page is None and has_time()):
+                running.add(executor.submit(fetch, next_page))
+                next_page += 1
+
+            if not running:
+                break
+
+            finished, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                page, reviews, ms = future.result()
+                pages[page] = reviews
+                page_ms = max(page_ms, ms)
+
+                if since is not None and (seen_page is None
+                                          or page < seen_page):
+                    if any(high_water.is_seen(r, since) for r in reviews):
+                        seen_page = page
 
-def get_all_reviews(price: int, url: str,  maxpages: int):
     reviews = []
+    for page in sorted(pages):
+        # 取得済みの感想が見つかったページより後は捨てる
+        # (並行して取得していた分)
+        if seen_page is not None and page > seen_page:
+            break
+        reviews += pages[page]
 
-    for page in range(0, maxpages):
-        reviews_per_page = get_reviews_per_page(price, url, page+1)
-        reviews += reviews_per_page
+    reviews, reached = high_water.new_reviews(reviews, since)
+    if reached:
+        return reviews, None
 
-    return reviews
+    return reviews, (next_page if next_page <= maxpages else None)
 
 
 def lambda_handler(event, context):
@@ -66,8 +163,17 @@ def lambda_handler(event, context):
         url      : 感想一覧ページのURL
         price    : 商品価格
         maxpages : 感想一覧ページ数
+        concurrency : 同時に取得するページ数 (省略可)
+        start_page  : このページから取得する (省略時は 1)
+        end_page    : このページまで取得する (省略時は maxpages)
+        since       : 前回の high-water mark (省略可)
+                      {'date': 最新の感想の日付, 'fingerprint': その感想の値}
+                      前回取得済みの感想に当たったら，そこで打ち切る
 
     returns:
+        body : 感想のリストを payload.encode したもの
+               (大きければ圧縮，さらに大きければ BLOB_STORE に置いた名前)
+               感想は次の順に並ぶ
         title   : 感想タイトル
         gender  : 性別
         age     : 年齢
@@ -77,16 +183,36 @@ def lambda_handler(event, context):
         label   : ラベル
         text    : 本文
         reason  : 商品を選んだ理由
+
+        next_page    : 制限時間が近づいて打ち切った場合，次に取得するページ
+                       (最後まで取得した場合，since に当たった場合は None)
+        http_retries : HTTP のリトライ回数と待ち時間 (秒)
+        http_cache   : HTTP キャッシュのヒット数など
     """
 
     url = event['url']
     price = int(event['price'])
     maxpages = int(event['maxpages'])
+    start_page = int(event.get('start_page', 1))
+    end_page = min(int(event.get('end_page', maxpages)), maxpages)
+    concurrency = int(event.get('concurrency', CONCURRENCY))
+    # コネクションプールより多く並行しても意味がない
+    concurrency = max(1, min(concurrency, http_session.POOL_MAXSIZE))
+
+    # 制限時間の前に打ち切って，取得できた分を返す
+    remaining = getattr(context, 'get_remaining_time_in_millis', None)
+    since = event.get('since')
 
-    body = get_all_reviews(price, url, maxpages)
+    http_session.RETRY_STATS.reset()
+    http_cache.CACHE_STATS.reset()
+    body, next_page = get_all_reviews(price, url, end_page, concurrency,
+                                      start_page, remaining, since)
 
     return {
         'statusCode': 200,
-        'body': json.dumps(body).encode('utf-8')
+        'body': payload.encode(body, BLOB_STORE),
+        'next_page': next_page,
+        'http_retries': http_session.RETRY_STATS.to_dict(),
+        'http_cache': http_cache.CACHE_STATS.to_dict(),
     }
 
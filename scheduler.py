@@ -0,0 +1,55 @@
+import heapq
+from typing import Callable, List
+
+
+def lpt_order(jobs: list, cost: Callable) -> list:
+    # 重いジョブから順に並べる (Longest Processing Time first)
+    return sorted(jobs, key=cost, reverse=True)
+
+
+def makespan(costs: List[float], workers: int) -> float:
+    """
+    空いたワーカーに順番にジョブを渡したときの完了時間を見積もる
+    (Pool.imap_unordered で chunksize=1 にしたときの割り当てと同じ)
+    """
+
+    loads = [0.0] * max(1, min(workers, len(costs)))
+    for cost in costs:
+        load = heapq.heappop(loads)
+        heapq.heappush(loads, load + cost)
+
+    return max(loads, default=0.0)
+
+
+class Makespan:
+    """
+    見積もった完了時間と実際の完了時間を比べる
+
+    見積もりの単位はジョブのコスト (感想ページ数など) なので，
+    実際にかかった時間からコストあたりの秒数を求めて秒に換算する
+    ワーカー数 (同時実行数) は実行中に変わることがあるので，
+    見積もりは終わってから report に渡したワーカー数で行う
+    """
+
+    def __init__(self, costs: List[float]):
+        self.costs = costs
+        self.total = sum(costs)
+        self.busy = 0.0
+        self.done = 0.0
+
+    def record(self, cost: float, seconds: float):
+        # 1ジョブ分の実績を記録
+        self.done += cost
+        self.busy += seconds
+
+    def report(self, elapsed: float, workers: int, basis: str = 'workers'):
+        # basis : ワーカー数が何の値か (出力に書く)
+        workers = max(1, workers)
+        predicted = makespan(self.costs, workers)
+        print('predicted makespan: %.0f (lower bound %.0f = %.0f / %d %s)'
+              % (predicted, self.total / workers, self.total, workers, basis))
+
+        if self.done > 0:
+            per_cost = self.busy / self.done
+            print('predicted: %.1f s, actual: %.1f s (%.3f s per unit)'
+                  % (predicted * per_cost, elapsed, per_cost))
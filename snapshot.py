@@ -0,0 +1,142 @@
+import argparse
+import math
+import sqlite3
+import time
+from typing import Dict, List, Optional
+import result_writer
+
+DEFAULT_PATH = 'snapshot.sqlite'
+
+# 1ページの感想数
+REVIEWS_PER_PAGE = 10
+
+
+class Snapshot:
+    """
+    感想一覧ページURL -> 前回取得したときの感想数と high-water mark
+
+    reviews.py が商品の感想を保存するたびに記録する
+    --delta のときは，これと urls.csv の感想数を比べて，
+    増えた分の感想だけを取得する
+    (high-water mark があれば，Lambda が前回の感想に当たった所で止める)
+
+    チェックポイントとは別のファイルにするので，--resume なしで
+    最初からやり直しても消えない
+    """
+
+    def __init__(self, path: str = DEFAULT_PATH):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS review_counts ('
+            ' url TEXT PRIMARY KEY,'
+            ' count INTEGER NOT NULL,'
+            ' updated REAL NOT NULL)'
+        )
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS high_water ('
+            ' url TEXT PRIMARY KEY,'
+            ' date TEXT NOT NULL,'
+            ' fingerprint TEXT NOT NULL)'
+        )
+        self.conn.commit()
+
+    def get_many(self, urls: List[str]) -> Dict[str, int]:
+        counts = {}
+        for url in urls:
+            row = self.conn.execute(
+                'SELECT count FROM review_counts WHERE url = ?',
+                (url,)).fetchone()
+            if row:
+                counts[url] = row[0]
+        return counts
+
+    def put(self, url: str, count: int):
+        self.put_many({url: count})
+
+    def put_many(self, counts: Dict[str, int]):
+        now = time.time()
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO review_counts VALUES (?, ?, ?)',
+            [(url, count, now) for url, count in counts.items()])
+        self.conn.commit()
+
+    def get_marks(self, urls: List[str]) -> Dict[str, dict]:
+        # URL -> {'date': ..., 'fingerprint': ...} (high_water.mark と同じ形)
+        marks = {}
+        for url in urls:
+            row = self.conn.execute(
+                'SELECT date, fingerprint FROM high_water WHERE url = ?',
+                (url,)).fetchone()
+            if row:
+                marks[url] = {'date': row[0], 'fingerprint': row[1]}
+        return marks
+
+    def put_mark(self, url: str, mark: dict):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO high_water VALUES (?, ?, ?)',
+            (url, mark['date'], mark['fingerprint']))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def new_reviews(count: Optional[int], previous: Optional[int]):
+    """
+    前回からの新しい感想の数
+
+        None : 全て取得する (前回の記録か，今回の感想数が分からない)
+        0    : 取得しない (増えていない)
+        n    : 先頭の n 件だけ取得する (感想は新しい順に並んでいる)
+
+    感想が減った場合 (削除など) も取得しない
+    """
+
+    if count is None or previous is None:
+        return None
+
+    return max(0, count - previous)
+
+
+def pages_for(reviews: int) -> int:
+    # 先頭の reviews 件を含むページ数
+    return math.ceil(reviews / REVIEWS_PER_PAGE)
+
+
+def seed(snapshot: Snapshot, path: str) -> int:
+    """
+    urls.csv の感想数をそのまま記録する
+    (前回の感想を取得済みで，記録だけない場合に使う)
+    """
+
+    counts = {}
+    for row in result_writer.read_rows(path):
+        if len(row) > 3:
+            counts[row[1]] = int(row[3])
+
+    snapshot.put_many(counts)
+    return len(counts)
+
+
+def add_arguments(parser):
+    # ドライバ共通のコマンドライン引数
+    parser.add_argument('--delta', action='store_true',
+                        help='前回から増えた感想だけ取得する')
+    parser.add_argument('--snapshot', default=DEFAULT_PATH,
+                        help='前回の感想数の記録 (SQLite)')
+
+
+if __name__ == "__main__":
+    # python snapshot.py --seed urls.csv
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--snapshot', default=DEFAULT_PATH,
+                        help='前回の感想数の記録 (SQLite)')
+    parser.add_argument('--seed', metavar='URLS_CSV', required=True,
+                        help='この urls.csv の感想数を取得済みとして記録する')
+    options = parser.parse_args()
+
+    snapshot = Snapshot(options.snapshot)
+    try:
+        print(seed(snapshot, options.seed), 'products recorded.')
+    finally:
+        snapshot.close()
@@ -1,17 +1,25 @@
 import pprint as pp
 from bs4 import BeautifulSoup
-import urllib
+import urllib.request
 from urllib.parse import urljoin
-import boto3
 import json
+import os
+import lambda_client
 from typing import List
-import csv
-from multiprocessing import Pool
-from itertools import chain
-
-DOMAIN = 'https://www.furusato-tax.jp'
+from functools import partial
+import argparse
+import checkpoint
+from checkpoint import Checkpoint
+import concurrency
+import result_writer
+
+# ORIGIN_DOMAIN を指定すると，ローカルの代替サーバーなどに向けられる
+DOMAIN = os.environ.get('ORIGIN_DOMAIN', 'https://www.furusato-tax.jp')
 ROOT_URL = urljoin(DOMAIN, 'search?sort=11')
 
+# 中身のない一覧ページがこれだけ続いたら，最後のページを過ぎたとみなす
+EMPTY_PAGES_STOP = 24
+
 
 def fetch_html(url):
     # URLからHTMLを返す
@@ -21,21 +29,34 @@ def fetch_html(url):
 
 # レビューの一覧ページを取得する関数（lambdaを呼び出す関数）
 def get_review_pages(url: str):
-    client = boto3.client('lambda')
     payload = {
         "url": url
     }
-    response = client.invoke(
-        FunctionName='urls',
-        InvocationType='RequestResponse',
-        Payload=json.dumps(payload).encode('utf-8'),
-    )
-    decoded = response['Payload'].read().decode('utf-8')
+    decoded = lambda_client.invoke('urls', payload)
     data = json.loads(decoded)
     body = json.loads(data['body'])
     return body
 
 
+# 失敗しても止まらないように，(URL, 結果, エラー) を返す
+def try_get_review_pages(url: str):
+    try:
+        return url, get_review_pages(url), None
+    except Exception as e:
+        print('FAILED', url, e)
+        return url, None, str(e)
+
+
+def page_outcome(result) -> str:
+    # try_get_review_pages の結果が成功 / 失敗 / スロットリングのどれか
+    _, _, error = result
+    if error is None:
+        return concurrency.OK
+    if lambda_client.is_throttled(error):
+        return concurrency.THROTTLED
+    return concurrency.ERROR
+
+
 # 商品一覧ページの最大ページ数を抽出
 def max_products_page_num() -> int:
     # HTMLを取得
@@ -64,6 +85,16 @@ def generate_products_urls(max_pages: int) -> List[str]:
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    checkpoint.add_arguments(parser)
+    lambda_client.add_arguments(parser)
+    concurrency.add_arguments(parser)
+    result_writer.add_arguments(parser)
+    options = parser.parse_args()
+
+    ckpt = Checkpoint('urls', options.checkpoint)
+    stats = lambda_client.new_stats()
+
     try:
         # 商品一覧ページの最大ページ数を抽出
         max_pages = max_products_page_num()
@@ -71,35 +102,74 @@ if __name__ == "__main__":
         # 全ての商品一覧ページを生成
         products_urls = generate_products_urls(max_pages)
 
-        """
-        感想一覧ページの [値段, URL, 最大ページ数] のリスト
+        # 完了済み (--resume) / 失敗以外 (--only-failed) を除外
+        products_urls = ckpt.pending(products_urls, options.mode)
 
-        - 本番は、products_urls に対してループを回す
-        - ここは並列化できる
         """
-        # 100ずつ並行処理
-        bulk_size = 24
-        bulk_num = 1
-        for i in range(0, len(products_urls), bulk_size):
-            print("bulk", bulk_num)
-            urls = products_urls[i:i+bulk_size]
-
-            p = Pool(8)
-            result = p.map(get_review_pages, urls)
-            result_flat = list(chain.from_iterable(result))
-
-            pp.pprint(result_flat)
-
-            with open('urls.csv', 'a', newline='') as f:
-                writer = csv.writer(f)
-                writer.writerows(result_flat)
+        感想一覧ページの [値段, URL, 最大ページ数, 感想数] のリスト
 
-                f.close()
-
-            if len(result_flat) == 0:
-                break
-
-            bulk_num += 1
+        - 1ページ終わるごとに次のページの Lambda を呼び出す
+        - 同時実行数はスロットリングされない範囲で自動的に増減する
+        - 中身のないページが EMPTY_PAGES_STOP ページ続いたら，その先は取得しない
+        - 結果は届いた順 (--ordered ならページ順) に1ページずつ書き込む
+        """
+        page_index = {url: i for i, url in enumerate(products_urls)}
+        empty_pages = set()
+        stop = len(products_urls)
+
+        def page_urls():
+            for i, url in enumerate(products_urls):
+                if i >= stop:
+                    return
+                yield url
+
+        controller = concurrency.from_arguments(options)
+        done = 0
+
+        # 同時に実行中になるのはページの数まで
+        workers = max(1, min(controller.maximum, len(products_urls)))
+        with lambda_client.new_pool(workers, options.max_pool_connections,
+                                    stats, options.invoker) as p, \
+                result_writer.open_writer(
+                    result_writer.output_path('urls', options.format),
+                    options.format, options.ordered) as writer:
+
+            results = concurrency.imap_adaptive(
+                p, try_get_review_pages, page_urls(), controller,
+                page_outcome)
+            for _, (url, body, error) in results:
+                done += 1
+                if done % 100 == 0:
+                    print('done', done, 'window', controller.limit)
+
+                # 1ページずつ，書き込んだら進捗を記録する
+                i = page_index[url]
+                if error is not None:
+                    writer.put(i, None)
+                    ckpt.failed(url, error)
+                    continue
+
+                pp.pprint(body)
+                writer.put(i, body, partial(ckpt.done, url, body))
+
+                if len(body) > 0:
+                    continue
+
+                # 中身のないページが続いていたら，その先は投げない
+                empty_pages.add(i)
+                first, last = i, i
+                while first - 1 in empty_pages:
+                    first -= 1
+                while last + 1 in empty_pages:
+                    last += 1
+                if last - first + 1 >= EMPTY_PAGES_STOP:
+                    stop = min(stop, first)
+
+        controller.report()
 
     except RuntimeError as e:
         print(e)
+
+    finally:
+        ckpt.close()
+        lambda_client.report(stats)
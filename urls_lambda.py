@@ -1,20 +1,37 @@
 import json
-import urllib
+import os
+import http_cache
+import http_session
+import parsing
 from typing import List
-from bs4 import BeautifulSoup
+from bs4 import SoupStrainer
 from urllib.parse import urljoin
 import re
 import math
 
 
-DOMAIN = 'https://www.furusato-tax.jp'
+# ORIGIN_DOMAIN を指定すると，ローカルの代替サーバーなどに向けられる
+DOMAIN = os.environ.get('ORIGIN_DOMAIN', 'https://www.furusato-tax.jp')
 ROOT_URL = urljoin(DOMAIN, 'search?sort=11')
 
+# 商品一覧ページは商品カードだけパースする
+CARD_STRAINER = SoupStrainer(class_='card-product')
 
-def fetch_html(url):
+
+def fetch_html(url, parse_only: SoupStrainer = None):
     # URLからHTMLを返す
-    res = urllib.request.urlopen(url)
-    return BeautifulSoup(res, 'html.parser')
+    return parse_response(http_session.get(url), parse_only)
+
+
+def parse_response(res, parse_only: SoupStrainer = None):
+    # レスポンスからHTMLを返す
+    # (文字コードが分からない場合だけ BeautifulSoup に判定させ，
+    #  結果をホストごとに覚えておく)
+    encoding = http_session.known_encoding(res)
+    soup = parsing.parse(res.content, parse_only, from_encoding=encoding)
+    if encoding is None:
+        http_session.remember_encoding(res.url, soup.original_encoding)
+    return soup
 
 
 def get_ip_addr():
@@ -30,70 +47,94 @@ def find_reviews_urls(products_url: str) -> List[str]:
 
     1. 感想一覧ページのURLを取得
     2. 例えば 234 / 10 = 23 なので、24 ページまでとわかる
-    3. [商品の値段, 1 のURL, 2 のページ数] を保存する
+    3. [商品の値段, 1 のURL, 2 のページ数, 感想数] を保存する
+       (感想数は，前回から増えた感想だけ取得するときに使う)
 
     returns:
 
         [[商品Aの値段
-         [商品Bの値段, 感想一覧ページのURL, 最大ページ数],
-         [商品Cの値段, 感想一覧ページのURL, 最大ページ数],
-         [商品Dの値段, 感想一覧ページのURL, 最大ページ数],
+         [商品Bの値段, 感想一覧ページのURL, 最大ページ数, 感想数],
+         [商品Cの値段, 感想一覧ページのURL, 最大ページ数, 感想数],
+         [商品Dの値段, 感想一覧ページのURL, 最大ページ数, 感想数],
          ... ]
 
     """
 
+    # 商品一覧ページが変わっていなければ (304)，前回パースした結果を使う
+    return http_session.get_parsed(products_url, 'urls', parse_listing)
+
+
+def parse_listing(res) -> list:
     # 商品一覧ページのHTMLを取得
-    soup = fetch_html(products_url)
+    soup = parse_response(res, CARD_STRAINER)
 
     # 商品カード
     product_cards = soup.select('.card-product')
 
-    # list of [商品の値段, 感想一覧ページのURL, 最大ページ数]
+    # list of [商品の値段, 感想一覧ページのURL, 最大ページ数, 感想数]
     price_url_maxpages = []
     for card in product_cards:
-        price_elem = card.select_one('.card-product__price')
-        url_elem = card.select_one('.card-product__comment')
+        row = parse_card(card)
 
-        # 存在しない場合がある
-        if price_elem is None or url_elem is None:
+        # 感想がない商品などは除く
+        if row is None:
             continue
 
-        # href属性の取得
-        href = url_elem.get('href')
+        price_url_maxpages.append(row)
 
-        # 存在しない場合がある
-        if href is None:
-            continue
+    return price_url_maxpages
 
-        # 相対URL -> 絶対URL
-        url = urljoin(DOMAIN, href)
 
-        # 感想ページ数の取得
-        # '感想(211)' -> 211
-        kansou_str = list(url_elem.children)[2]
-        # カッコの中を正規表現で抽出
-        max_pages_str = re.search(r'(?<=\().*(?=\))', kansou_str).group()
-        # 10 で割って繰り上げ
-        max_pages = math.ceil(int(max_pages_str) / 10)
+def parse_card(card):
+    # 商品カードから [商品の値段, 感想一覧ページのURL, 最大ページ数, 感想数]
+    # を取り出す
+    # 感想がない商品などは None
+    price_elem = card.select_one('.card-product__price')
+    url_elem = card.select_one('.card-product__comment')
 
-        # '10,000\xa0円' -> '10,000 円' -> '10,000'
-        price_str = price_elem.string.replace(u'\xa0', ' ').split()[0]
-        # '10,000' -> 10000
-        price = int(price_str.replace(',', ''))
+    # 存在しない場合がある
+    if price_elem is None or url_elem is None:
+        return None
 
-        # [商品の値段, 感想一覧ページのURL, 最大ページ数]
-        price_url_maxpages.append([price, url, max_pages])
+    # href属性の取得
+    href = url_elem.get('href')
 
-    return price_url_maxpages
+    # 存在しない場合がある
+    if href is None:
+        return None
+
+    # 相対URL -> 絶対URL
+    url = urljoin(DOMAIN, href)
+
+    # 感想ページ数の取得
+    # '感想(211)' -> 211
+    kansou_str = list(url_elem.children)[2]
+    # カッコの中を正規表現で抽出
+    max_pages_str = re.search(r'(?<=\().*(?=\))', kansou_str).group()
+    count = int(max_pages_str)
+    # 10 で割って繰り上げ
+    max_pages = math.ceil(count / 10)
+
+    # '10,000\xa0円' -> '10,000 円' -> '10,000'
+    price_str = price_elem.string.replace(u'\xa0', ' ').split()[0]
+    # '10,000' -> 10000
+    price = int(price_str.replace(',', ''))
+
+    # [商品の値段, 感想一覧ページのURL, 最大ページ数, 感想数]
+    return [price, url, max_pages, count]
 
 
 def lambda_handler(event, context):
     # ip = get_ip_addr()
     # print(ip)
     url = event["url"]
+    http_session.RETRY_STATS.reset()
+    http_cache.CACHE_STATS.reset()
     body = find_reviews_urls(url)
     # TODO implement
     return {
         'statusCode': 200,
-        'body': json.dumps(body)
+        'body': json.dumps(body),
+        'http_retries': http_session.RETRY_STATS.to_dict(),
+        'http_cache': http_cache.CACHE_STATS.to_dict(),
     }